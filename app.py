@@ -1,16 +1,149 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify
 import requests
+from requests.adapters import HTTPAdapter
 import os
+import sys
+import bisect
+import heapq
 import json
+import logging
+import logging.handlers
+import random
+import hashlib
+import queue
+import sqlite3
+import atexit
+import functools
+import gzip
+import threading
+import time
+import zlib
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta
+
+try:
+    import brotli
+except ImportError:
+    # Без brotli статика отдаётся в gzip
+    brotli = None
+
+# Статику отдаёт свой маршрут с хэшем содержимого в имени
+app = Flask(__name__, static_folder=None)
+
+# Логирование: записи копятся в очереди и пишутся в stdout фоновым потоком
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text')
+LOG_MAX_PAYLOAD = int(os.environ.get('LOG_MAX_PAYLOAD', 500))
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+
+def _parse_sample_rates(raw):
+    """Разбирает строку вида "webhook=0.01,telegram=0.5" """
+    rates = {}
+    for item in raw.split(','):
+        category, _, rate = item.partition('=')
+        if category.strip() and rate.strip():
+            rates[category.strip()] = float(rate)
+    return rates
+
+# Доля INFO/DEBUG событий, которые пишутся, по категориям (предупреждения и ошибки пишутся всегда)
+LOG_SAMPLE_RATES = _parse_sample_rates(os.environ.get('LOG_SAMPLE_RATES', ''))
+# Категории, отключённые полностью, например "api,telegram"
+LOG_DISABLED = {name.strip() for name in os.environ.get('LOG_DISABLED', '').split(',') if name.strip()}
+
+class _Payload:
+    """Полезная нагрузка для лога: форматируется только при записи и обрезается"""
+
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        text = str(self.value)
+        if len(text) > LOG_MAX_PAYLOAD:
+            return f"{text[:LOG_MAX_PAYLOAD]}... (+{len(text) - LOG_MAX_PAYLOAD} chars)"
+        return text
+
+class _CategoryFilter(logging.Filter):
+    """Отключает категории и прореживает частые события"""
+
+    def filter(self, record):
+        category = record.name.rpartition('.')[2]
+        if category in LOG_DISABLED:
+            return False
+        rate = LOG_SAMPLE_RATES.get(category)
+        if rate is not None and record.levelno < logging.WARNING:
+            return random.random() < rate
+        return True
 
-app = Flask(__name__)
+class _StructuredFormatter(logging.Formatter):
+    """Текстовый или JSON-формат с дополнительными полями из extra={'fields': ...}"""
+
+    def format(self, record):
+        fields = getattr(record, 'fields', None) or {}
+        category = record.name.rpartition('.')[2]
+        if LOG_FORMAT == 'json':
+            entry = {'ts': round(record.created, 3), 'level': record.levelname,
+                     'category': category, 'msg': record.getMessage()}
+            entry.update(fields)
+            return json.dumps(entry, ensure_ascii=False, default=str)
+        line = f"{self.formatTime(record)} {record.levelname} [{category}] {record.getMessage()}"
+        if fields:
+            line += ' ' + ' '.join(f"{key}={value}" for key, value in fields.items())
+        return line
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler, который при переполнении теряет запись, а не блокирует запрос"""
+
+    dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+def _start_log_listener():
+    """Запускает поток записи логов (заново - после fork воркера)"""
+    global _log_listener
+    _log_handler.queue = queue.Queue(LOG_QUEUE_SIZE)
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(_StructuredFormatter())
+    _log_listener = logging.handlers.QueueListener(_log_handler.queue, output)
+    _log_listener.start()
+
+_log_handler = _DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+_log_handler.addFilter(_CategoryFilter())
+log = logging.getLogger('donk')
+log.setLevel(LOG_LEVEL)
+log.addHandler(_log_handler)
+log.propagate = False
+_start_log_listener()
+atexit.register(lambda: _log_listener.stop())
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_start_log_listener)
+
+app_log = logging.getLogger('donk.app')
+telegram_log = logging.getLogger('donk.telegram')
+settings_log = logging.getLogger('donk.settings')
+api_log = logging.getLogger('donk.api')
+webhook_log = logging.getLogger('donk.webhook')
 
 BOT_TOKEN = os.environ.get('BOT_TOKEN')
-ALLOWED_USER_IDS = [1444832263, 848736128]
-GROUP_CHAT_ID = -1001721934457
-
-# Текущие настройки в памяти
-current_settings = {
+# Администраторы бота: ALLOWED_USER_IDS через запятую
+ALLOWED_USER_IDS = frozenset(
+    int(user_id) for user_id in os.environ.get('ALLOWED_USER_IDS', '1444832263,848736128').split(',')
+    if user_id.strip()
+)
+# Управляемые группы: GROUP_CHAT_IDS через запятую, первая - группа по умолчанию
+GROUP_CHAT_IDS = [
+    int(chat_id) for chat_id in os.environ.get('GROUP_CHAT_IDS', '-1001721934457').split(',')
+    if chat_id.strip()
+]
+GROUP_CHAT_ID = GROUP_CHAT_IDS[0]
+
+# Настройки новой группы до первой синхронизации
+DEFAULT_SETTINGS = {
     'can_send_messages': True,
     'can_send_media_messages': True,
     'can_send_photos': True,
@@ -24,73 +157,1632 @@ current_settings = {
     'can_pin_messages': False
 }
 
-def telegram_api(method, data):
+# Готовые наборы разрешений для мини-приложения (частичные карты поверх текущих настроек)
+_MEDIA_SETTINGS = ('can_send_media_messages', 'can_send_photos', 'can_send_videos',
+                   'can_send_video_notes', 'can_send_voice_notes', 'can_send_stickers')
+PERMISSION_PRESETS = {
+    'lock_media': {
+        'title': '🔒 Закрыть медиа',
+        'settings': {key: False for key in _MEDIA_SETTINGS},
+    },
+    'read_only': {
+        'title': '🚫 Только чтение',
+        'settings': dict({key: False for key in _MEDIA_SETTINGS},
+                         can_send_messages=False, can_send_polls=False),
+    },
+    'open_all': {
+        'title': '✅ Открыть всё',
+        'settings': dict({key: True for key in _MEDIA_SETTINGS},
+                         can_send_messages=True, can_send_polls=True),
+    },
+}
+
+# Разрешения группы как битовая маска: бит i - PERMISSION_BITS[i].
+# Порядок фиксирован, новые флаги добавляются только в конец
+PERMISSION_BITS = tuple(DEFAULT_SETTINGS)
+PERMISSION_FLAGS = {key: 1 << index for index, key in enumerate(PERMISSION_BITS)}
+ALL_PERMISSIONS = (1 << len(PERMISSION_BITS)) - 1
+
+def pack_permissions(permissions, base=0):
+    """Маска из карты ChatPermissions; отсутствующие ключи берутся из base, чужие игнорируются"""
+    mask = base
+    for key, value in permissions.items():
+        flag = PERMISSION_FLAGS.get(key)
+        if flag is not None:
+            mask = mask | flag if value else mask & ~flag
+    return mask
+
+def unpack_permissions(mask):
+    """Карта ChatPermissions из маски"""
+    return {key: bool(mask & flag) for key, flag in PERMISSION_FLAGS.items()}
+
+DEFAULT_MASK = pack_permissions(DEFAULT_SETTINGS)
+
+def changed_permissions(old, new):
+    """Имена разрешений, которые различаются в двух масках"""
+    diff = old ^ new
+    return [key for key, flag in PERMISSION_FLAGS.items() if diff & flag]
+
+# Различных масок всего 2 ** len(PERMISSION_BITS), поэтому кэши ниже ограничены сами собой
+@functools.lru_cache(maxsize=ALL_PERMISSIONS + 1)
+def permissions_json(mask):
+    """ChatPermissions маски в JSON"""
+    return json.dumps(unpack_permissions(mask))
+
+@functools.lru_cache(maxsize=ALL_PERMISSIONS + 1)
+def permissions_digest(mask):
+    """Короткий хэш маски для ETag"""
+    return hashlib.sha1(permissions_json(mask).encode('utf-8')).hexdigest()[:8]
+
+# Метрики в формате Prometheus (у каждого процесса свои)
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(names, values)) + '}'
+
+class Counter:
+    """Счётчик с метками"""
+
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labels, key)} {value}" for key, value in items]
+
+class Gauge:
+    """Текущее значение: задаётся явно или читается из функции при выдаче метрик"""
+
+    def __init__(self, name, help, callback=None, kind='gauge'):
+        self.name = name
+        self.help = help
+        self.callback = callback
+        # kind='counter' - для уже накопленных где-то монотонных значений
+        self.kind = kind
+        self._lock = threading.Lock()
+        self._value = 0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def value(self):
+        return self.callback() if self.callback is not None else self._value
+
+    def render(self):
+        return [f"{self.name} {self.value()}"]
+
+class Histogram:
+    """Гистограмма длительностей с фиксированными корзинами"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=METRICS_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(label_values)
+            if entry is None:
+                entry = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self):
+        with self._lock:
+            items = [(key, (list(counts), total, count)) for key, (counts, total, count) in self._values.items()]
+        lines = []
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labels + ('le',), key + (bound,))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labels, key)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+class MetricsRegistry:
+    """Набор метрик процесса"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+http_request_duration = metrics.register(Histogram(
+    'donk_http_request_duration_seconds', 'HTTP request latency by route',
+    ('route', 'method', 'status')))
+telegram_request_duration = metrics.register(Histogram(
+    'donk_telegram_request_duration_seconds', 'Telegram Bot API call latency per attempt', ('method',)))
+telegram_errors = metrics.register(Counter(
+    'donk_telegram_errors_total', 'Failed Telegram Bot API attempts', ('method', 'error_code')))
+telegram_in_flight = metrics.register(Gauge(
+    'donk_telegram_in_flight', 'Telegram Bot API calls currently in flight'))
+
+# Настройки исходящего HTTP-клиента Telegram
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL', 'https://api.telegram.org').rstrip('/')
+TELEGRAM_POOL_SIZE = int(os.environ.get('TELEGRAM_POOL_SIZE', 10))
+TELEGRAM_CONNECT_TIMEOUT = float(os.environ.get('TELEGRAM_CONNECT_TIMEOUT', 3.05))
+TELEGRAM_READ_TIMEOUT = float(os.environ.get('TELEGRAM_READ_TIMEOUT', 10))
+TELEGRAM_MAX_RETRIES = int(os.environ.get('TELEGRAM_MAX_RETRIES', 3))
+TELEGRAM_RETRY_BACKOFF = float(os.environ.get('TELEGRAM_RETRY_BACKOFF', 0.5))
+TELEGRAM_MAX_RETRY_DELAY = float(os.environ.get('TELEGRAM_MAX_RETRY_DELAY', 5))
+
+def _create_session():
+    """Создаёт общий HTTP-клиент с пулом keep-alive соединений"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=TELEGRAM_POOL_SIZE,
+                          pool_maxsize=TELEGRAM_POOL_SIZE,
+                          pool_block=True)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+telegram_session = _create_session()
+
+def _retry_delay(result, attempt):
+    """Возвращает паузу перед повтором или None, если повторять не нужно"""
+    error_code = result.get('error_code')
+    if error_code == 429:
+        retry_after = (result.get('parameters') or {}).get('retry_after')
+        if retry_after is not None:
+            delay = float(retry_after)
+            # Ждать дольше лимита бессмысленно - запрос всё равно не успеет
+            return delay if delay <= TELEGRAM_MAX_RETRY_DELAY else None
+    elif error_code is None or error_code < 500:
+        return None
+    return min(TELEGRAM_RETRY_BACKOFF * (2 ** attempt), TELEGRAM_MAX_RETRY_DELAY)
+
+# Предохранитель: при отказах Telegram вызовы сразу завершаются ошибкой, а не ждут таймаута
+TELEGRAM_BREAKER = os.environ.get('TELEGRAM_BREAKER', '1').lower() in ('1', 'true', 'yes')
+TELEGRAM_BREAKER_FAILURE_RATE = float(os.environ.get('TELEGRAM_BREAKER_FAILURE_RATE', 0.5))
+TELEGRAM_BREAKER_WINDOW = int(os.environ.get('TELEGRAM_BREAKER_WINDOW', 20))
+TELEGRAM_BREAKER_MIN_CALLS = int(os.environ.get('TELEGRAM_BREAKER_MIN_CALLS', 5))
+TELEGRAM_BREAKER_OPEN_SECONDS = float(os.environ.get('TELEGRAM_BREAKER_OPEN_SECONDS', 30))
+TELEGRAM_BREAKER_PROBES = int(os.environ.get('TELEGRAM_BREAKER_PROBES', 1))
+
+CIRCUIT_STATES = {'closed': 0, 'half_open': 1, 'open': 2}
+
+class CircuitBreaker:
+    """Размыкается при доле отказов выше порога, пробует восстановление пробными вызовами"""
+
+    def __init__(self, failure_rate, window, min_calls, open_seconds, probes):
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.open_seconds = open_seconds
+        self.probes = probes
+        self.state = 'closed'
+        self._lock = threading.Lock()
+        # Исходы последних попыток: True - отказ
+        self._outcomes = deque(maxlen=window)
+        self._opened_at = 0.0
+        self._probes_left = 0
+        self._probe_successes = 0
+
+    def _transition(self, state):
+        self.state = state
+        circuit_transitions.inc(state)
+        if state == 'open':
+            self._opened_at = time.monotonic()
+            telegram_log.warning("🔌 Telegram circuit opened for %.0f s", self.open_seconds)
+        elif state == 'half_open':
+            self._probes_left = self.probes
+            self._probe_successes = 0
+            telegram_log.info("🔌 Telegram circuit half-open, sending %d probe(s)", self.probes)
+        else:
+            self._outcomes.clear()
+            telegram_log.info("✅ Telegram circuit closed")
+
+    def retry_in(self):
+        """Сколько секунд предохранитель ещё будет разомкнут (0 - вызовы пропускаются)"""
+        if self.state != 'open':
+            return 0.0
+        return max(0.0, self._opened_at + self.open_seconds - time.monotonic())
+
+    def allow(self):
+        """Можно ли сделать попытку; в полуоткрытом состоянии пропускает только пробы"""
+        with self._lock:
+            if self.state == 'open':
+                if self.retry_in() > 0:
+                    return False
+                self._transition('half_open')
+            if self.state == 'half_open':
+                if self._probes_left <= 0:
+                    return False
+                self._probes_left -= 1
+            return True
+
+    def record(self, failed):
+        with self._lock:
+            if self.state == 'half_open':
+                if failed:
+                    self._transition('open')
+                else:
+                    self._probe_successes += 1
+                    if self._probe_successes >= self.probes:
+                        self._transition('closed')
+                return
+            if self.state == 'open':
+                return
+            self._outcomes.append(failed)
+            failures = sum(self._outcomes)
+            if len(self._outcomes) >= self.min_calls and failures / len(self._outcomes) >= self.failure_rate:
+                self._transition('open')
+
+    def rejected(self, method):
+        """Ответ вместо вызова, пока предохранитель разомкнут"""
+        circuit_rejected.inc(method)
+        return {'ok': False, 'error_code': 503, 'circuit_open': True,
+                'description': f'Telegram API unavailable, retry in {self.retry_in():.0f} s'}
+
+def _is_outage(result):
+    """Отказ Telegram (нет ответа или 5xx), а не ошибка самого запроса"""
+    if result.get('ok'):
+        return False
+    error_code = result.get('error_code')
+    return error_code is None or error_code >= 500
+
+circuit_transitions = metrics.register(Counter(
+    'donk_telegram_circuit_transitions_total', 'Telegram circuit breaker state changes', ('state',)))
+circuit_rejected = metrics.register(Counter(
+    'donk_telegram_circuit_rejected_total', 'Telegram calls failed fast by the circuit breaker', ('method',)))
+telegram_breaker = CircuitBreaker(TELEGRAM_BREAKER_FAILURE_RATE, TELEGRAM_BREAKER_WINDOW,
+                                  TELEGRAM_BREAKER_MIN_CALLS, TELEGRAM_BREAKER_OPEN_SECONDS,
+                                  TELEGRAM_BREAKER_PROBES)
+metrics.register(Gauge('donk_telegram_circuit_state', 'Telegram circuit breaker: 0 closed, 1 half-open, 2 open',
+                       lambda: CIRCUIT_STATES[telegram_breaker.state]))
+
+def _record_attempt(method, started, result, attempt):
+    """Метрики и журнал одной завершённой попытки вызова"""
+    elapsed = (time.monotonic() - started) * 1000
+    telegram_in_flight.dec()
+    telegram_request_duration.observe(elapsed / 1000, method)
+    if TELEGRAM_BREAKER:
+        telegram_breaker.record(_is_outage(result))
+    if result.get('ok'):
+        telegram_log.info("📡 Response: %s in %.0f ms: %s", method, elapsed, _Payload(result),
+                          extra={'fields': {'method': method, 'ms': round(elapsed)}})
+        return
+    telegram_errors.inc(method, result.get('error_code') or 'network')
+    telegram_log.warning("❌ API Error: %s in %.0f ms (attempt %d): %s", method, elapsed, attempt + 1,
+                         _Payload(result), extra={'fields': {'method': method, 'ms': round(elapsed),
+                                                            'error_code': result.get('error_code')}})
+
+def _record_failure(method, started, error):
+    """Метрики и журнал вызова, упавшего с исключением"""
+    elapsed = (time.monotonic() - started) * 1000
+    telegram_in_flight.dec()
+    telegram_request_duration.observe(elapsed / 1000, method)
+    if TELEGRAM_BREAKER:
+        telegram_breaker.record(True)
+    telegram_errors.inc(method, type(error).__name__)
+    telegram_log.error("❌ API Error: %s failed after %.0f ms: %s", method, elapsed, error,
+                       extra={'fields': {'method': method, 'ms': round(elapsed)}})
+
+JSON_HEADERS = {'Content-Type': 'application/json'}
+
+class PreparedBody(dict):
+    """Тело вызова, уже сериализованное в encoded; сам dict нужен логу и диспетчеру"""
+
+    __slots__ = ('encoded',)
+
+    def __init__(self, data, encoded):
+        super().__init__(data)
+        self.encoded = encoded
+
+def permissions_request(chat_id, mask):
+    """Тело setChatPermissions; JSON разрешений берётся из кэша по маске"""
+    encoded = f'{{"chat_id": {json.dumps(chat_id)}, "permissions": {permissions_json(mask)}}}'
+    return PreparedBody({'chat_id': chat_id, 'permissions': unpack_permissions(mask)}, encoded.encode('utf-8'))
+
+def _telegram_request(method, data, read_timeout=None):
     """Прямой вызов Telegram Bot API"""
-    url = f"https://api.telegram.org/bot{BOT_TOKEN}/{method}"
-    try:
-        print(f"📡 API: {method} -> {data}")
-        response = requests.post(url, json=data, timeout=10)
-        result = response.json()
-        print(f"📡 Response: {result}")
+    url = f"{TELEGRAM_API_URL}/bot{BOT_TOKEN}/{method}"
+    timeout = (TELEGRAM_CONNECT_TIMEOUT, read_timeout or TELEGRAM_READ_TIMEOUT)
+    body = ({'data': data.encoded, 'headers': JSON_HEADERS} if isinstance(data, PreparedBody)
+            else {'json': data})
+    telegram_log.debug("📡 API: %s -> %s", method, _Payload(data))
+    attempt = 0
+    while True:
+        if TELEGRAM_BREAKER and not telegram_breaker.allow():
+            return telegram_breaker.rejected(method)
+        started = time.monotonic()
+        telegram_in_flight.inc()
+        try:
+            response = telegram_session.post(url, timeout=timeout, **body)
+            try:
+                result = response.json()
+            except ValueError:
+                result = {'ok': False, 'error_code': response.status_code,
+                          'description': f'HTTP {response.status_code}'}
+        except requests.ConnectionError as e:
+            # Обрыв соединения (например, протухший keep-alive) - повторяем с паузой
+            result = {'ok': False, 'description': f'Connection error: {e}'}
+            delay = min(TELEGRAM_RETRY_BACKOFF * (2 ** attempt), TELEGRAM_MAX_RETRY_DELAY)
+        except Exception as e:
+            _record_failure(method, started, e)
+            return {'ok': False, 'description': str(e)}
+        else:
+            delay = None if result.get('ok') else _retry_delay(result, attempt)
+
+        _record_attempt(method, started, result, attempt)
+        if result.get('ok') or delay is None or attempt >= TELEGRAM_MAX_RETRIES:
+            return result
+        attempt += 1
+        telegram_log.info("⏳ Retrying %s in %.1f s", method, delay)
+        time.sleep(delay)
+
+# Диспетчер исходящих вызовов: лимиты Telegram (глобальный и на чат) и приоритеты
+OUTBOUND_DISPATCHER = os.environ.get('OUTBOUND_DISPATCHER', '1').lower() in ('1', 'true', 'yes')
+OUTBOUND_WORKERS = int(os.environ.get('OUTBOUND_WORKERS', 8))
+OUTBOUND_GLOBAL_RATE = float(os.environ.get('OUTBOUND_GLOBAL_RATE', 30))
+OUTBOUND_GLOBAL_BURST = float(os.environ.get('OUTBOUND_GLOBAL_BURST', 30))
+OUTBOUND_CHAT_RATE = float(os.environ.get('OUTBOUND_CHAT_RATE', 1))
+OUTBOUND_CHAT_BURST = float(os.environ.get('OUTBOUND_CHAT_BURST', 3))
+# Классы, на которые действует лимит на чат (у Telegram он про сообщения)
+OUTBOUND_CHAT_LIMITED = {
+    name.strip() for name in os.environ.get('OUTBOUND_CHAT_LIMITED', 'message').split(',')
+    if name.strip()
+}
+# Классы, вызовы которых не ждут ответа (ставятся в очередь и сразу возвращаются)
+OUTBOUND_FIRE_AND_FORGET = {
+    name.strip() for name in os.environ.get('OUTBOUND_FIRE_AND_FORGET', 'message').split(',')
+    if name.strip()
+}
+
+# Сколько при выходе ждать отправки уже поставленных в очередь вызовов
+OUTBOUND_DRAIN_TIMEOUT = float(os.environ.get('OUTBOUND_DRAIN_TIMEOUT', 15))
+
+# Классы приоритета: чем меньше число, тем раньше уходит вызов
+PRIORITY_CLASSES = {'permissions': 0, 'read': 1, 'message': 2}
+METHOD_PRIORITIES = {
+    'setChatPermissions': 'permissions',
+    'getChat': 'read',
+    'setWebhook': 'read',
+    'deleteWebhook': 'read',
+    'sendMessage': 'message',
+}
+# Длинный опрос держал бы рабочий поток диспетчера десятки секунд
+DISPATCHER_BYPASS = {'getUpdates'}
+
+class TokenBucket:
+    """Корзина токенов; вызывается под блокировкой владельца"""
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now):
+        """Сколько ждать до следующего токена"""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_idle(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+class _OutboundCall:
+    """Вызов в очереди диспетчера"""
+
+    __slots__ = ('method', 'data', 'read_timeout', 'priority', 'chat_id',
+                 'queued_at', 'expected_wait', 'done', 'result')
+
+    def __init__(self, method, data, read_timeout, priority, chat_id):
+        self.method = method
+        self.data = data
+        self.read_timeout = read_timeout
+        self.priority = priority
+        self.chat_id = chat_id
+        self.queued_at = time.monotonic()
+        self.expected_wait = 0.0
+        self.done = threading.Event()
+        self.result = None
+
+class OutboundDispatcher:
+    """Очереди по приоритетам и рабочие потоки, уважающие лимиты Telegram"""
+
+    def __init__(self, workers, global_rate, global_burst, chat_rate, chat_burst):
+        self.workers = workers
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self._cond = threading.Condition()
+        self._queues = [deque() for _ in PRIORITY_CLASSES]
+        self._global = TokenBucket(global_rate, global_burst, time.monotonic())
+        self._chats = {}
+        self._chat_pending = {}
+        self._started = False
+        # Вызовы, которые рабочие потоки уже взяли и ещё выполняют
+        self._active = 0
+
+    def _chat_bucket(self, chat_id, now):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 10000:
+                # Забываем полные корзины давно молчащих чатов
+                self._chats = {key: value for key, value in self._chats.items() if not value.is_idle(now)}
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst, now)
+        return bucket
+
+    def depth(self, priority):
+        return len(self._queues[PRIORITY_CLASSES[priority]])
+
+    def pending(self):
+        """Вызовы в очередях и в работе"""
+        with self._cond:
+            return sum(len(calls) for calls in self._queues) + self._active
+
+    def shutdown(self, timeout=OUTBOUND_DRAIN_TIMEOUT):
+        """Дожидается отправки поставленных вызовов: ответы fire-and-forget иначе потеряются,
+        а Telegram их не повторит - вебхук уже ответил OK"""
+        if not self._started or not self.pending():
+            return
+        telegram_log.info("🛑 Draining outbound queue (%d pending)", self.pending())
+        deadline = time.monotonic() + timeout
+        while self.pending() and time.monotonic() < deadline:
+            time.sleep(0.05)
+        if self.pending():
+            telegram_log.warning("⚠️ %d Telegram calls were not sent before exit", self.pending())
+
+    def submit(self, method, data, read_timeout=None, priority=None, wait=None):
+        """Ставит вызов в очередь; ждёт результата, если класс не fire-and-forget"""
+        priority = priority or METHOD_PRIORITIES.get(method, 'read')
+        level = PRIORITY_CLASSES[priority]
+        if wait is None:
+            wait = priority not in OUTBOUND_FIRE_AND_FORGET
+        # chat_id нужен только для лимита на чат; остальные классы ограничены глобально
+        chat_id = data.get('chat_id') if priority in OUTBOUND_CHAT_LIMITED else None
+        call = _OutboundCall(method, data, read_timeout, level, chat_id)
+        with self._cond:
+            if not self._started:
+                self._start()
+            now = time.monotonic()
+            ahead = sum(len(self._queues[index]) for index in range(level + 1))
+            global_wait = max(0.0, ahead + 1 - self._global.tokens) / self._global.rate
+            chat_wait = 0.0
+            if call.chat_id is not None:
+                bucket = self._chat_bucket(call.chat_id, now)
+                # Вызовы этого чата с тем же или более высоким приоритетом уйдут раньше
+                pending = self._chat_pending.setdefault(call.chat_id, [0] * len(PRIORITY_CLASSES))
+                chat_wait = max(0.0, sum(pending[:level + 1]) + 1 - bucket.tokens) / bucket.rate
+                pending[level] += 1
+            call.expected_wait = max(global_wait, chat_wait, self._global.delay(now))
+            self._queues[level].append(call)
+            self._cond.notify()
+        if call.expected_wait > 1:
+            telegram_log.info("🚦 %s queued as %s, expected wait %.1f s", method, priority, call.expected_wait)
+        if not wait:
+            return {'ok': True, 'queued': True, 'expected_wait': round(call.expected_wait, 3)}
+        call.done.wait()
+        result = dict(call.result)
+        result['expected_wait'] = round(call.expected_wait, 3)
         return result
-    except Exception as e:
-        print(f"❌ API Error: {e}")
-        return {'ok': False}
 
-def apply_settings():
+    def reserve(self, priority, chat_id=None):
+        """Берёт токены в обход очереди (асинхронный клиент); возвращает 0 или сколько подождать"""
+        level = PRIORITY_CLASSES[priority]
+        if priority not in OUTBOUND_CHAT_LIMITED:
+            chat_id = None
+        with self._cond:
+            now = time.monotonic()
+            # Вызовы из очереди с тем же или более высоким приоритетом идут первыми
+            if any(self._queues[index] for index in range(level + 1)):
+                return 1 / self._global.rate
+            delay = self._global.delay(now)
+            if chat_id is not None:
+                delay = max(delay, self._chat_bucket(chat_id, now).delay(now))
+            if delay == 0:
+                self._global.take(now)
+                if chat_id is not None:
+                    self._chats[chat_id].take(now)
+            return delay
+
+    def _start(self):
+        self._started = True
+        for n in range(self.workers):
+            threading.Thread(target=self._worker, name=f'outbound-{n}', daemon=True).start()
+
+    def _next_call(self):
+        """Выбирает самый приоритетный вызов, чей чат не упёрся в лимит (под блокировкой)"""
+        while True:
+            now = time.monotonic()
+            wait = self._global.delay(now)
+            if wait == 0:
+                wait = None
+                for calls in self._queues:
+                    for index, call in enumerate(calls):
+                        delay = 0.0 if call.chat_id is None else self._chat_bucket(call.chat_id, now).delay(now)
+                        if delay == 0:
+                            del calls[index]
+                            self._global.take(now)
+                            if call.chat_id is not None:
+                                self._chats[call.chat_id].take(now)
+                                pending = self._chat_pending[call.chat_id]
+                                pending[call.priority] -= 1
+                                if not any(pending):
+                                    del self._chat_pending[call.chat_id]
+                            return call
+                        wait = delay if wait is None else min(wait, delay)
+            self._cond.wait(wait)
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                call = self._next_call()
+                self._active += 1
+            outbound_wait.observe(time.monotonic() - call.queued_at, call.method)
+            try:
+                call.result = _telegram_request(call.method, call.data, call.read_timeout)
+            except Exception as e:
+                call.result = {'ok': False, 'description': str(e)}
+            finally:
+                with self._cond:
+                    self._active -= 1
+            call.done.set()
+
+outbound_dispatcher = OutboundDispatcher(OUTBOUND_WORKERS, OUTBOUND_GLOBAL_RATE, OUTBOUND_GLOBAL_BURST,
+                                         OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST)
+# atexit вызывает обработчики в обратном порядке: регистрация раньше очереди обновлений
+# (она регистрируется при первом обновлении) значит, что исходящие досылаются после её разбора
+atexit.register(outbound_dispatcher.shutdown)
+outbound_wait = metrics.register(Histogram(
+    'donk_outbound_wait_seconds', 'Time Telegram calls spend queued in the dispatcher', ('method',)))
+for _priority in PRIORITY_CLASSES:
+    metrics.register(Gauge(f'donk_outbound_queue_{_priority}', f'Queued {_priority} Telegram calls',
+                           lambda priority=_priority: outbound_dispatcher.depth(priority)))
+
+def telegram_api(method, data, read_timeout=None, priority=None, wait=None):
+    """Вызов Telegram Bot API через диспетчер лимитов и приоритетов"""
+    # Пока предохранитель разомкнут, не занимаем очередь и токены
+    if TELEGRAM_BREAKER and telegram_breaker.retry_in() > 0:
+        return telegram_breaker.rejected(method)
+    if not OUTBOUND_DISPATCHER or method in DISPATCHER_BYPASS:
+        return _telegram_request(method, data, read_timeout)
+    return outbound_dispatcher.submit(method, data, read_timeout, priority, wait)
+
+# Кэш ответов getChat: свежие отдаются сразу, устаревшие - с фоновым обновлением
+GETCHAT_CACHE_TTL = float(os.environ.get('GETCHAT_CACHE_TTL', 5))
+GETCHAT_STALE_TTL = float(os.environ.get('GETCHAT_STALE_TTL', 30))
+
+class _Flight:
+    """Выполняющийся запрос getChat, к которому присоединяются остальные"""
+
+    def __init__(self, generation):
+        self.done = threading.Event()
+        self.result = None
+        self.generation = generation
+
+class ChatInfoCache:
+    """TTL-кэш getChat с объединением одновременных запросов (single-flight)"""
+
+    def __init__(self, ttl, stale_ttl):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._flights = {}
+        self._generations = {}
+
+    def get(self, chat_id, fresh=False):
+        """Возвращает ответ getChat; fresh=True всегда идёт в Telegram"""
+        return self.get_versioned(chat_id, fresh)[0]
+
+    def get_versioned(self, chat_id, fresh=False):
+        """Возвращает (ответ getChat, поколение, в котором начался его запрос)"""
+        if not fresh:
+            result, stale, generation = self.lookup(chat_id)
+            if result is not None:
+                if stale:
+                    self._refresh_in_background(chat_id)
+                return result, generation
+        return self._fetch(chat_id)
+
+    def lookup(self, chat_id):
+        """Возвращает (ответ из кэша или None, пора ли его обновить, его поколение)"""
+        with self._lock:
+            entry = self._entries.get(chat_id)
+        if entry is None:
+            return None, True, None
+        age = time.monotonic() - entry[0]
+        if age < self.ttl:
+            return entry[1], False, entry[2]
+        if age < self.ttl + self.stale_ttl:
+            return entry[1], True, entry[2]
+        return None, True, None
+
+    def generation(self, chat_id):
+        with self._lock:
+            return self._generations.get(chat_id, 0)
+
+    def is_current(self, chat_id, generation):
+        """Не было ли invalidate() после начала запроса этого поколения"""
+        return self.generation(chat_id) == generation
+
+    def store(self, chat_id, generation, result):
+        """Кэширует ответ, если с начала запроса не было invalidate()"""
+        with self._lock:
+            # Ответ, полученный до invalidate(), мог устареть - не кэшируем его
+            if result.get('ok') and self._generations.get(chat_id, 0) == generation:
+                self._entries[chat_id] = (time.monotonic(), result, generation)
+
+    def invalidate(self, chat_id):
+        """Сбрасывает запись, в том числе ответ уже идущего запроса"""
+        with self._lock:
+            self._entries.pop(chat_id, None)
+            self._generations[chat_id] = self._generations.get(chat_id, 0) + 1
+
+    def _refresh_in_background(self, chat_id):
+        with self._lock:
+            if chat_id in self._flights:
+                return
+        threading.Thread(target=self._fetch, args=(chat_id,), daemon=True).start()
+
+    def _fetch(self, chat_id):
+        with self._lock:
+            flight = self._flights.get(chat_id)
+            is_leader = flight is None
+            if is_leader:
+                flight = self._flights[chat_id] = _Flight(self._generations.get(chat_id, 0))
+
+        if not is_leader:
+            flight.done.wait()
+            return flight.result, flight.generation
+
+        result = {'ok': False}
+        try:
+            result = telegram_api('getChat', {'chat_id': chat_id})
+        finally:
+            self.store(chat_id, flight.generation, result)
+            with self._lock:
+                del self._flights[chat_id]
+            flight.result = result
+            flight.done.set()
+        return result, flight.generation
+
+chat_info_cache = ChatInfoCache(GETCHAT_CACHE_TTL, GETCHAT_STALE_TTL)
+
+class ChatState:
+    """Состояние настроек одной группы"""
+
+    __slots__ = ('chat_id', 'mask', 'acknowledged', 'stored', 'stored_ack', 'synced', 'restored',
+                 'version', 'revision', 'lock', 'apply_lock', 'pending', 'applying')
+
+    def __init__(self, chat_id):
+        self.chat_id = chat_id
+        # Желаемые настройки (маска PERMISSION_BITS)
+        self.mask = DEFAULT_MASK
+        # Маска последнего состояния, подтверждённого Telegram (None - ещё неизвестно)
+        self.acknowledged = None
+        # mask и acknowledged в том виде, в каком они лежат в хранилище: их разница с текущими -
+        # ещё не записанные изменения этого процесса
+        self.stored = self.mask
+        self.stored_ack = None
+        self.synced = False
+        # Состояние восстановлено из хранилища и ещё не сверено с Telegram
+        self.restored = False
+        # Версия записи в хранилище, растёт при каждом сохранении
+        self.version = 0
+        # Ревизия желаемых настроек, растёт при каждом их изменении (ETag и If-Match)
+        self.revision = 0
+        # lock защищает mask/revision/pending, apply_lock упорядочивает отправки в Telegram
+        self.lock = threading.Lock()
+        self.apply_lock = threading.Lock()
+        self.pending = None
+        # Идёт setChatPermissions: getChat может вернуть состояние до него
+        self.applying = False
+
+    @property
+    def settings(self):
+        """Желаемые настройки картой ChatPermissions (копия)"""
+        return unpack_permissions(self.mask)
+
+    def merge(self, changes):
+        """Вносит изменения под self.lock; ревизия растёт, только если что-то поменялось"""
+        self.assign(pack_permissions(changes, self.mask))
+
+    def assign(self, mask):
+        """Заменяет маску под self.lock"""
+        if mask != self.mask:
+            self.mask = mask
+            self.revision += 1
+
+    def rebase(self, mask, acknowledged, version, revision):
+        """Принимает запись хранилища под self.lock, сохраняя незаписанные изменения этого процесса;
+        True, если настройки или ревизия изменились"""
+        before = (self.mask, self.revision)
+        local = self.mask ^ self.stored
+        merged = (mask & ~local) | (self.mask & local)
+        # Своё подтверждение Telegram оставляем, только если оно получено после последней записи
+        if self.acknowledged == self.stored_ack:
+            self.acknowledged = acknowledged
+        # Ревизия не откатывается; слияние со своими изменениями новее обеих сторон
+        self.revision = max(self.revision, revision) + (1 if merged != mask else 0)
+        self.mask = merged
+        self.stored, self.stored_ack = mask, acknowledged
+        self.version = version
+        # Кэшированный (или уже идущий) getChat старше записи другого процесса
+        chat_info_cache.invalidate(self.chat_id)
+        return (self.mask, self.revision) != before
+
+    def _etag(self):
+        # Ревизия упорядочивает версии, хэш отличает их после перезапуска без хранилища
+        return f"{self.revision}-{permissions_digest(self.mask)}"
+
+    def versioned(self):
+        """Согласованные (настройки, ревизия, ETag)"""
+        with self.lock:
+            return unpack_permissions(self.mask), self.revision, self._etag()
+
+class ChatRegistry:
+    """Индекс состояний групп по chat_id; набор групп задаётся GROUP_CHAT_IDS при старте"""
+
+    def __init__(self, chat_ids):
+        self._chats = {chat_id: ChatState(chat_id) for chat_id in chat_ids}
+
+    def get(self, chat_id):
+        return self._chats.get(chat_id)
+
+    def __iter__(self):
+        return iter(self._chats.values())
+
+    def __len__(self):
+        return len(self._chats)
+
+chats = ChatRegistry(GROUP_CHAT_IDS)
+
+# Постоянное хранилище настроек; пустой SETTINGS_DB_PATH отключает его
+SETTINGS_DB_PATH = os.environ.get('SETTINGS_DB_PATH', 'settings.db')
+SETTINGS_DB_FLUSH_INTERVAL = float(os.environ.get('SETTINGS_DB_FLUSH_MS', 200)) / 1000
+# Общее состояние для нескольких процессов: запись сразу, перечитывание по счётчику версий
+SHARED_STATE = os.environ.get('SHARED_STATE', '').lower() in ('1', 'true', 'yes')
+
+class SettingsStore:
+    """Хранилище желаемых и подтверждённых настроек групп в SQLite (WAL)"""
+
+    def __init__(self, path, flush_interval, shared=False):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.shared = shared
+        # Последняя версия хранилища, которую видел этот процесс
+        self.version = 0
+        # Одно соединение на чтение и одно на запись на процесс: чтение в WAL не ждёт записи
+        self._connections = {}
+        self._locks = {'read': threading.Lock(), 'write': threading.Lock()}
+        self._dirty = {}
+        self._cond = threading.Condition()
+        self._version_lock = threading.Lock()
+        self._writer = None
+        # Последняя запись не удалась: пока фоновый поток её не допишет, запросы не ждут SQLite
+        self._failing = False
+        self._migrate()
+
+    def _migrate(self):
+        """Схема и миграции - один раз при создании хранилища"""
+        with self._locks['write']:
+            conn = self._connection('write')
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS chat_settings ('
+                'chat_id INTEGER PRIMARY KEY, settings TEXT NOT NULL, '
+                'acknowledged TEXT, updated_at REAL NOT NULL, '
+                'version INTEGER NOT NULL DEFAULT 0, revision INTEGER NOT NULL DEFAULT 0)')
+            columns = {row[1] for row in conn.execute('PRAGMA table_info(chat_settings)')}
+            for column in ('version', 'revision'):
+                if column not in columns:
+                    conn.execute(f'ALTER TABLE chat_settings ADD COLUMN {column} INTEGER NOT NULL DEFAULT 0')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS state_version ('
+                'id INTEGER PRIMARY KEY CHECK (id = 0), version INTEGER NOT NULL)')
+            conn.execute('INSERT OR IGNORE INTO state_version (id, version) VALUES (0, 0)')
+
+    def _connection(self, purpose):
+        """Соединение процесса для чтения или записи; вызывать под self._locks[purpose]"""
+        # После fork соединение родителя не используем
+        pid = os.getpid()
+        entry = self._connections.get(purpose)
+        if entry is None or entry[0] != pid:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA synchronous=NORMAL')
+            entry = self._connections[purpose] = (pid, conn)
+        return entry[1]
+
+    @staticmethod
+    def _decode(settings, acknowledged):
+        """Маски (желаемая, подтверждённая) из строки хранилища"""
+        mask = pack_permissions(json.loads(settings), DEFAULT_MASK)
+        # Ключи, которых нет в сохранённом подтверждении, считаем неподтверждёнными
+        return mask, (pack_permissions(json.loads(acknowledged), ALL_PERMISSIONS ^ mask)
+                      if acknowledged else None)
+
+    def _apply_rows(self, registry, rows, restored=False):
+        loaded = []
+        for chat_id, settings, acknowledged, version, revision in rows:
+            state = registry.get(chat_id)
+            if state is None or (not restored and version <= state.version):
+                continue
+            mask, acknowledged = self._decode(settings, acknowledged)
+            with state.lock:
+                state.rebase(mask, acknowledged, version, revision)
+                state.restored = state.restored or restored
+            loaded.append(state)
+        return loaded
+
+    def load(self, registry):
+        """Восстанавливает состояние управляемых групп, возвращает число загруженных"""
+        with self._locks['read'], self._version_lock:
+            conn = self._connection('read')
+            self.version = conn.execute('SELECT version FROM state_version').fetchone()[0]
+            rows = conn.execute(
+                'SELECT chat_id, settings, acknowledged, version, revision FROM chat_settings').fetchall()
+        return len(self._apply_rows(registry, rows, restored=True))
+
+    def refresh(self, registry):
+        """Подтягивает изменения других процессов, возвращает изменившиеся группы"""
+        with self._locks['read']:
+            conn = self._connection('read')
+            version = conn.execute('SELECT version FROM state_version').fetchone()[0]
+            if version <= self.version:
+                return []
+            with self._version_lock:
+                known, self.version = self.version, max(self.version, version)
+            rows = conn.execute(
+                'SELECT chat_id, settings, acknowledged, version, revision FROM chat_settings '
+                'WHERE version > ?', (known,)).fetchall()
+        changed = self._apply_rows(registry, rows)
+        if changed:
+            settings_log.info("🔁 Reloaded %d chats from shared state (version %d)", len(changed), version)
+        return changed
+
+    def save(self, state):
+        """Запоминает состояние группы для записи (в общем режиме - сразу)"""
+        with self._cond:
+            self._dirty[state.chat_id] = state
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write_loop, name='settings-store', daemon=True)
+                self._writer.start()
+                atexit.register(self.flush)
+            if not self.shared:
+                self._cond.notify()
+        # В общем режиме другие процессы должны увидеть изменение до ответа клиенту
+        if self.shared and not self._failing:
+            try:
+                self.flush()
+            except Exception as e:
+                # Запрос не падает: изменения остались в очереди, их допишет фоновый поток
+                settings_log.error("❌ Settings store error, will retry: %s", e)
+        if self.shared and self._failing:
+            with self._cond:
+                self._cond.notify()
+
+    def flush(self):
+        """Записывает накопленные изменения одной транзакцией"""
+        with self._cond:
+            dirty, self._dirty = self._dirty, {}
+        if not dirty:
+            return
+        now = time.time()
+        try:
+            with self._locks['write']:
+                conn = self._connection('write')
+                with conn:
+                    conn.execute('BEGIN IMMEDIATE')
+                    conn.execute('UPDATE state_version SET version = version + 1')
+                    version = conn.execute('SELECT version FROM state_version').fetchone()[0]
+                    written = [(state,) + self._write(conn, state, version, now) for state in dirty.values()]
+        except Exception:
+            # Возвращаем пачку для повтора; записи, появившиеся за это время, новее
+            with self._cond:
+                dirty.update(self._dirty)
+                self._dirty = dirty
+            self._failing = True
+            raise
+        self._failing = False
+        rebased = []
+        for state, (mask, acknowledged), merged in written:
+            with state.lock:
+                state.version = max(state.version, version)
+                state.stored, state.stored_ack = mask, acknowledged
+            if merged:
+                rebased.append(state)
+        with self._version_lock:
+            # Собственную запись перечитывать не нужно, если до неё мы были в курсе всех версий
+            if self.version == version - 1:
+                self.version = version
+        if rebased:
+            settings_log.info("🔀 Merged changes of another process for %d chats", len(rebased))
+            for state in rebased:
+                settings_broadcaster.publish(state)
+
+    def _write(self, conn, state, version, now):
+        """Пишет строку группы, только если её версия не сменилась; иначе переносит свои изменения
+        поверх чужой записи и пишет результат. Возвращает ((mask, acknowledged), было ли слияние)"""
+        merged = False
+        while True:
+            with state.lock:
+                expected, mask, acknowledged, revision = state.version, state.mask, state.acknowledged, state.revision
+            row = (permissions_json(mask), permissions_json(acknowledged) if acknowledged is not None else None,
+                   now, version, revision)
+            cursor = conn.execute(
+                'UPDATE chat_settings SET settings = ?, acknowledged = ?, updated_at = ?, version = ?, '
+                'revision = MAX(revision, ?) WHERE chat_id = ? AND version = ?', row + (state.chat_id, expected))
+            if cursor.rowcount:
+                return (mask, acknowledged), merged
+            stored = conn.execute('SELECT settings, acknowledged, version, revision FROM chat_settings '
+                                  'WHERE chat_id = ?', (state.chat_id,)).fetchone()
+            if stored is None:
+                conn.execute('INSERT INTO chat_settings (settings, acknowledged, updated_at, version, revision, '
+                             'chat_id) VALUES (?, ?, ?, ?, ?, ?)', row + (state.chat_id,))
+                return (mask, acknowledged), merged
+            # Строку переписал другой процесс - транзакция держит блокировку, второй проход запишет
+            stored_mask, stored_ack = self._decode(stored[0], stored[1])
+            with state.lock:
+                state.rebase(stored_mask, stored_ack, stored[2], stored[3])
+            merged = True
+
+    def _write_loop(self):
+        while True:
+            with self._cond:
+                while not self._dirty:
+                    self._cond.wait()
+            # Даём накопиться соседним изменениям, чтобы записать их вместе
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                settings_log.error("❌ Settings store error, will retry: %s", e)
+
+class _NullStore:
+    """Заглушка, когда постоянное хранилище отключено"""
+
+    shared = False
+
+    def load(self, registry):
+        return 0
+
+    def refresh(self, registry):
+        return []
+
+    def save(self, state):
+        pass
+
+    def flush(self):
+        pass
+
+settings_store = (SettingsStore(SETTINGS_DB_PATH, SETTINGS_DB_FLUSH_INTERVAL, shared=SHARED_STATE)
+                  if SETTINGS_DB_PATH else _NullStore())
+restored_chats = settings_store.load(chats)
+
+# Рассылка снимков настроек открытым мини-приложениям (Server-Sent Events)
+SSE_HEARTBEAT = float(os.environ.get('SSE_HEARTBEAT', 15))
+SSE_MAX_CLIENTS = int(os.environ.get('SSE_MAX_CLIENTS', 100))
+
+class SettingsBroadcaster:
+    """Раздаёт новые снимки настроек подписчикам своей группы"""
+
+    def __init__(self, max_clients):
+        self.max_clients = max_clients
+        self._lock = threading.Lock()
+        self._subscribers = {}
+        self._last_sent = {}
+        self.clients = 0
+
+    def subscribe(self, chat_id):
+        """Возвращает очередь событий или None, если подписчиков слишком много"""
+        events = queue.Queue(maxsize=4)
+        with self._lock:
+            if self.clients >= self.max_clients:
+                return None
+            self._subscribers.setdefault(chat_id, set()).add(events)
+            self.clients += 1
+        return events
+
+    def unsubscribe(self, chat_id, events):
+        with self._lock:
+            subscribers = self._subscribers.get(chat_id)
+            if subscribers is not None and events in subscribers:
+                subscribers.discard(events)
+                self.clients -= 1
+                if not subscribers:
+                    del self._subscribers[chat_id]
+
+    def publish(self, state):
+        """Отправляет снимок группы, если он отличается от последнего разосланного"""
+        with state.lock:
+            # version - ревизия настроек, как в ответах API и на странице
+            message = json.dumps({'settings': state.settings, 'version': state.revision,
+                                  'etag': state._etag()})
+        with self._lock:
+            if self._last_sent.get(state.chat_id) == message:
+                return
+            self._last_sent[state.chat_id] = message
+            subscribers = list(self._subscribers.get(state.chat_id, ()))
+        for events in subscribers:
+            # Медленному клиенту нужен только последний снимок - старые выбрасываем
+            while True:
+                try:
+                    events.put_nowait(message)
+                    break
+                except queue.Full:
+                    try:
+                        events.get_nowait()
+                    except queue.Empty:
+                        pass
+
+settings_broadcaster = SettingsBroadcaster(SSE_MAX_CLIENTS)
+
+def _settings_changed(state):
+    """Сохраняет изменённое состояние группы и оповещает открытые мини-приложения"""
+    settings_store.save(state)
+    settings_broadcaster.publish(state)
+
+def refresh_shared_state():
+    """В общем режиме подтягивает изменения других процессов и рассылает их мини-приложениям"""
+    if settings_store.shared:
+        for state in settings_store.refresh(chats):
+            settings_broadcaster.publish(state)
+
+def _apply_snapshot(state, force=False):
+    """Снимок настроек для отправки или None, если Telegram уже их знает"""
+    with state.lock:
+        mask, acknowledged = state.mask, state.acknowledged
+        if not force and mask == acknowledged:
+            settings_log.info("⏭️ Apply skipped for %s: Telegram already has these settings", state.chat_id)
+            return None
+        # Кэшированный или уже идущий getChat показывает состояние до этой отправки
+        state.applying = True
+        chat_info_cache.invalidate(state.chat_id)
+    if acknowledged is not None:
+        settings_log.debug("🧮 Changed permissions for %s: %s", state.chat_id,
+                           _Payload(changed_permissions(acknowledged, mask)))
+    return mask
+
+def _apply_finished(state, mask, result):
+    """Учитывает ответ на setChatPermissions (вызывается после каждого _apply_snapshot, вернувшего маску)"""
+    # Под state.lock, чтобы _merge_synced не принял getChat, начатый до этой отправки
+    with state.lock:
+        state.applying = False
+        if result.get('ok'):
+            state.acknowledged = mask
+            state.synced = True
+            chat_info_cache.invalidate(state.chat_id)
+    if result.get('ok'):
+        _settings_changed(state)
+    settings_log.info("🎯 Apply settings result for %s: %s", state.chat_id, _Payload(result))
+
+def apply_settings(chat_id=GROUP_CHAT_ID, force=False):
     """Применяет текущие настройки к группе"""
-    data = {
-        'chat_id': GROUP_CHAT_ID,
-        'permissions': {
-            'can_send_messages': current_settings['can_send_messages'],
-            'can_send_media_messages': current_settings['can_send_media_messages'],
-            'can_send_photos': current_settings['can_send_photos'],
-            'can_send_videos': current_settings['can_send_videos'],
-            'can_send_video_notes': current_settings['can_send_video_notes'],
-            'can_send_voice_notes': current_settings['can_send_voice_notes'],
-            'can_send_stickers': current_settings['can_send_stickers'],
-            'can_send_polls': current_settings['can_send_polls'],
-            'can_change_info': current_settings['can_change_info'],
-            'can_invite_users': current_settings['can_invite_users'],
-            'can_pin_messages': current_settings['can_pin_messages']
-        }
-    }
-    result = telegram_api('setChatPermissions', data)
-    print(f"🎯 Apply settings result: {result}")
+    state = chats.get(chat_id)
+    # Снимок должен включать изменения, которые другие процессы успели записать
+    refresh_shared_state()
+    mask = _apply_snapshot(state, force)
+    if mask is None:
+        return {'ok': True, 'result': True, 'skipped': True}
+
+    try:
+        result = telegram_api('setChatPermissions', permissions_request(chat_id, mask))
+    except Exception as e:
+        result = {'ok': False, 'description': str(e)}
+    _apply_finished(state, mask, result)
     return result
 
-def update_setting(setting_name, value):
-    """Обновляет настройку и применяет её"""
-    print(f"🔄 Setting {setting_name} to {value}")
-    current_settings[setting_name] = value
-    return apply_settings()
+# Окно, в течение которого изменения настроек копятся перед отправкой
+SETTINGS_BATCH_WINDOW = float(os.environ.get('SETTINGS_BATCH_WINDOW_MS', 150)) / 1000
+# Сколько ждёт результата пачки запрос, присоединившийся к чужой отправке
+SETTINGS_BATCH_WAIT_TIMEOUT = float(os.environ.get('SETTINGS_BATCH_WAIT_TIMEOUT', 60))
+# Ответ присоединившемуся запросу, если отправка пачки не завершилась вовремя
+BATCH_WAIT_TIMEOUT = {'ok': False, 'description': 'Timed out waiting for the settings to be applied'}
+
+class _PendingApply:
+    """Ожидающая отправки пачка изменений одного чата"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.size = 0
+        self.result = None
+        # Асинхронные ожидающие (ASGI-режим): (event loop, future)
+        self._futures = []
+        self._lock = threading.Lock()
+
+    def wait_async(self, loop):
+        """Future для ожидания результата из event loop"""
+        future = loop.create_future()
+        with self._lock:
+            if not self.done.is_set():
+                self._futures.append((loop, future))
+                return future
+        future.set_result(self.result)
+        return future
+
+    def finish(self, result):
+        with self._lock:
+            self.result = result
+            self.done.set()
+            futures, self._futures = self._futures, []
+        for loop, future in futures:
+            loop.call_soon_threadsafe(_resolve_future, future, result)
+
+def _resolve_future(future, result):
+    if not future.done():
+        future.set_result(result)
+
+class SettingsBatcher:
+    """Склеивает изменения настроек за короткое окно в один setChatPermissions"""
+
+    def __init__(self, window):
+        self.window = window
+
+    def join(self, chat_id, changes, expected=None):
+        """Вносит изменения в снимок настроек; возвращает (состояние, пачка, ведущий ли вызов);
+        пачка None - версия не совпала с expected (ETags из If-Match)"""
+        state = chats.get(chat_id)
+        with state.lock:
+            if expected is not None and not expected.contains(state._etag()):
+                return state, None, False
+            state.merge(changes)
+            batch = state.pending
+            is_leader = batch is None
+            if is_leader:
+                batch = state.pending = _PendingApply()
+            batch.size += 1
+        _settings_changed(state)
+        return state, batch, is_leader
+
+    @staticmethod
+    def close(state, batch):
+        """Закрывает пачку перед отправкой (под apply_lock): дальнейшие изменения пойдут в новую"""
+        with state.lock:
+            state.pending = None
+        if batch.size > 1:
+            settings_log.info("📦 Coalesced %d setting changes for %s into one apply", batch.size, state.chat_id)
+
+    def submit(self, chat_id, changes, window=None, expected=None):
+        """Вносит изменения в снимок настроек и ждёт общего результата отправки"""
+        window = self.window if window is None else window
+        state, batch, is_leader = self.join(chat_id, changes, expected)
+        if batch is None:
+            return VERSION_CONFLICT
+
+        if not is_leader:
+            if not batch.done.wait(SETTINGS_BATCH_WAIT_TIMEOUT):
+                settings_log.warning("⏱️ Gave up waiting for the settings batch of %s", chat_id)
+                return BATCH_WAIT_TIMEOUT
+            return batch.result
+
+        result = None
+        try:
+            if window > 0:
+                time.sleep(window)
+            # Отправки одного чата идут строго по очереди, чтобы не переставить состояния
+            with state.apply_lock:
+                self.close(state, batch)
+                result = apply_settings(chat_id)
+        except Exception as e:
+            result = {'ok': False, 'description': str(e)}
+        finally:
+            batch.finish(result)
+        return result
+
+settings_batcher = SettingsBatcher(SETTINGS_BATCH_WINDOW)
+# Ответ на запись с устаревшим If-Match
+VERSION_CONFLICT = {'ok': False, 'conflict': True, 'description': 'Settings were changed by someone else'}
 
-def get_current_settings():
-    """Получает текущие настройки из Telegram"""
-    result = telegram_api('getChat', {'chat_id': GROUP_CHAT_ID})
+def update_setting(chat_id, setting_name, value, expected=None):
+    """Обновляет настройку и применяет её"""
+    settings_log.info("🔄 Setting %s to %s in %s", setting_name, value, chat_id)
+    return settings_batcher.submit(chat_id, {setting_name: value}, expected=expected)
+
+def update_settings(chat_id, changes, expected=None):
+    """Обновляет несколько настроек разом и применяет их одним вызовом"""
+    settings_log.info("🔄 Setting %s in %s", changes, chat_id)
+    return settings_batcher.submit(chat_id, changes, expected=expected)
+
+def validate_settings(changes):
+    """Проверяет карту разрешений, возвращает (нормализованная карта, ошибка)"""
+    if not isinstance(changes, dict) or not changes:
+        return None, 'Settings must be a non-empty object'
+    unknown = [key for key in changes if key not in DEFAULT_SETTINGS]
+    if unknown:
+        return None, 'Invalid setting: ' + ', '.join(unknown)
+    return {key: bool(value) for key, value in changes.items()}, None
+
+def get_current_settings(chat_id=GROUP_CHAT_ID, fresh=False):
+    """Получает текущие настройки из Telegram: (разрешения, поколение кэша getChat)"""
+    result, generation = chat_info_cache.get_versioned(chat_id, fresh=fresh)
+    return _chat_permissions(chat_id, result), generation
+
+def _chat_permissions(chat_id, result):
+    """Разрешения из ответа getChat или {} при ошибке"""
     if result.get('ok'):
         permissions = result['result'].get('permissions', {})
-        print(f"📋 Current Telegram settings: {permissions}")
+        settings_log.debug("📋 Current Telegram settings for %s: %s", chat_id, _Payload(permissions))
         return permissions
-    print("❌ Failed to get current settings from Telegram")
+    settings_log.warning("❌ Failed to get current settings for %s from Telegram", chat_id)
     return {}
 
-def sync_settings():
+def sync_settings(chat_id=GROUP_CHAT_ID, fresh=False):
     """Синхронизирует настройки с Telegram"""
-    global current_settings
-    telegram_settings = get_current_settings()
+    return _merge_synced(chats.get(chat_id), *get_current_settings(chat_id, fresh=fresh))
+
+def _stale_sync(state, generation):
+    """getChat начался до последней отправки настроек (вызывать под state.lock)"""
+    if chat_info_cache.is_current(state.chat_id, generation):
+        return False
+    settings_log.info("⏭️ Stale getChat for %s ignored: settings were applied while it was in flight",
+                      state.chat_id)
+    return True
+
+def _merge_synced(state, telegram_settings, generation):
+    """Принимает состояние Telegram как подтверждённое; False, если его получить не удалось"""
     if telegram_settings:
-        # Обновляем только существующие ключи
-        for key in list(current_settings.keys()):
-            if key in telegram_settings:
-                current_settings[key] = telegram_settings[key]
-        print(f"🔄 Synced settings: {current_settings}")
+        with state.lock:
+            # Подтверждение от setChatPermissions новее такого ответа
+            if _stale_sync(state, generation):
+                return True
+            # Обновляем только известные ключи, недостающие берём из текущих настроек
+            confirmed = pack_permissions(telegram_settings, state.mask)
+            # Изменения, которые ждут отправки в пачке или уже отправляются, не затираем
+            if state.pending is None and not state.applying:
+                state.assign(confirmed)
+            state.acknowledged = confirmed
+            state.synced = True
+            state.restored = False
+        _settings_changed(state)
+        settings_log.info("🔄 Synced settings for %s: %s", state.chat_id, _Payload(permissions_json(state.mask)))
         return True
     return False
 
-# Загружаем настройки при старте
-print("🚀 Starting application...")
-sync_settings()
+def reconcile_settings(chat_id=GROUP_CHAT_ID):
+    """Сверяет восстановленное из хранилища состояние с Telegram"""
+    state = chats.get(chat_id)
+    with state.lock:
+        unapplied = state.restored and state.mask != state.acknowledged
+    if not unapplied:
+        # Нечего досылать - берём состояние Telegram, как при обычной синхронизации
+        return sync_settings(chat_id)
+
+    telegram_settings, generation = get_current_settings(chat_id, fresh=True)
+    if not telegram_settings:
+        return False
+    with state.apply_lock:
+        with state.lock:
+            if not _stale_sync(state, generation):
+                # Ключи, которых Telegram не прислал, считаем неподтверждёнными - apply их дошлёт
+                state.acknowledged = pack_permissions(telegram_settings, ALL_PERMISSIONS ^ state.mask)
+            state.restored = False
+        settings_log.info("📤 Pushing unapplied restored settings for %s", chat_id)
+        result = apply_settings(chat_id)
+    return result.get('ok', False)
+
+# Первичная синхронизация идёт в фоне, чтобы старт не ждал Telegram
+INITIAL_SYNC_ATTEMPTS = int(os.environ.get('INITIAL_SYNC_ATTEMPTS', 5))
+INITIAL_SYNC_RETRY_DELAY = float(os.environ.get('INITIAL_SYNC_RETRY_DELAY', 2))
+
+_initial_sync_lock = threading.Lock()
+_initial_sync_started = False
+
+def _initial_sync():
+    """Сверяет настройки всех групп с Telegram с повторами при неудаче"""
+    for attempt in range(INITIAL_SYNC_ATTEMPTS):
+        pending = 0
+        for state in chats:
+            # Успешный apply уже дал подтверждённое состояние - getChat не нужен
+            if not state.synced and not reconcile_settings(state.chat_id):
+                pending += 1
+        if not pending:
+            return
+        time.sleep(min(INITIAL_SYNC_RETRY_DELAY * (2 ** attempt), 60))
+    settings_log.warning("⚠️ Initial sync failed for %d chats after %d attempts, use /api/sync",
+                        pending, INITIAL_SYNC_ATTEMPTS)
+
+def start_initial_sync():
+    """Запускает фоновую первичную синхронизацию (один раз на процесс)"""
+    global _initial_sync_started
+    if _initial_sync_started or not BOT_TOKEN:
+        return
+    with _initial_sync_lock:
+        if _initial_sync_started:
+            return
+        _initial_sync_started = True
+    threading.Thread(target=_initial_sync, name='initial-sync', daemon=True).start()
+
+# Профили разрешений и расписание их применения
+SCHEDULE_PATH = os.environ.get('SCHEDULE_PATH', '')
+SCHEDULER_ENABLED = os.environ.get('SCHEDULER_ENABLED', '1').lower() in ('1', 'true', 'yes')
+SCHEDULE_TIMEZONE = os.environ.get('SCHEDULE_TIMEZONE', '')
+# Пауза между применениями и окно, по которому размазываются одновременные задания
+SCHEDULE_MIN_INTERVAL = float(os.environ.get('SCHEDULE_MIN_INTERVAL', 0.1))
+SCHEDULE_SPREAD = float(os.environ.get('SCHEDULE_SPREAD', 30))
+
+class CronExpression:
+    """Cron-выражение из пяти полей: минута, час, день месяца, месяц, день недели"""
+
+    _RANGES = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, expression):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f"cron expression needs 5 fields: {expression!r}")
+        self.expression = expression
+        parsed = [self._parse(field, low, high) for field, (low, high) in zip(fields, self._RANGES)]
+        self.minutes, self.hours, self.days, self.months, weekdays = parsed
+        # 7 - тоже воскресенье; в Python понедельник - 0, поэтому сдвигаем
+        self.weekdays = {(day - 1) % 7 for day in weekdays}
+        self.any_day = fields[2] == '*'
+        self.any_weekday = fields[4] == '*'
+
+    @staticmethod
+    def _parse(field, low, high):
+        values = set()
+        for part in field.split(','):
+            part, _, step = part.partition('/')
+            if part == '*':
+                start, end = low, high
+            elif '-' in part:
+                start, end = (int(bound) for bound in part.split('-', 1))
+            else:
+                # Как в cron: 5/15 - это 5-59/15, а не только 5
+                start = int(part)
+                end = high if step else start
+            if start < low or end > high or start > end:
+                raise ValueError(f"cron field out of range: {field!r}")
+            values.update(range(start, end + 1, int(step) if step else 1))
+        return sorted(values)
+
+    def _day_matches(self, moment):
+        day_ok = moment.day in self.days
+        weekday_ok = moment.weekday() in self.weekdays
+        # Как в cron: если ограничены оба поля, достаточно совпадения любого
+        if not self.any_day and not self.any_weekday:
+            return day_ok or weekday_ok
+        return day_ok and weekday_ok
+
+    def next_after(self, moment):
+        """Ближайший момент срабатывания строго после moment"""
+        moment = moment.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        for _ in range(366 * 5):
+            if moment.month in self.months and self._day_matches(moment):
+                for hour in self.hours:
+                    if hour < moment.hour:
+                        continue
+                    for minute in self.minutes:
+                        if hour == moment.hour and minute < moment.minute:
+                            continue
+                        return moment.replace(hour=hour, minute=minute)
+            moment = (moment + timedelta(days=1)).replace(hour=0, minute=0)
+        raise ValueError(f"cron expression never fires: {self.expression!r}")
+
+class ScheduledJob:
+    """Применение профиля к группе по cron-расписанию"""
+
+    __slots__ = ('job_id', 'chat_id', 'profile', 'cron', 'offset', 'next_run', 'last_result')
+
+    def __init__(self, job_id, chat_id, profile, cron):
+        self.job_id = job_id
+        self.chat_id = chat_id
+        self.profile = profile
+        self.cron = CronExpression(cron)
+        # Постоянный сдвиг внутри SCHEDULE_SPREAD, чтобы тысячи заданий не стреляли разом
+        self.offset = zlib.crc32(f"{job_id}:{chat_id}".encode()) % 1000 / 1000 * SCHEDULE_SPREAD
+        self.next_run = None
+        self.last_result = None
+
+    def plan(self, now):
+        """Вычисляет следующий запуск (unix time)"""
+        fire = self.cron.next_after(datetime.fromtimestamp(now - self.offset, _schedule_tz()))
+        self.next_run = fire.timestamp() + self.offset
+        return self.next_run
+
+def _schedule_tz():
+    if not SCHEDULE_TIMEZONE:
+        return None
+    from zoneinfo import ZoneInfo
+    return ZoneInfo(SCHEDULE_TIMEZONE)
+
+class ProfileScheduler:
+    """Один поток-таймер на куче заданий и один поток, применяющий профили с паузами"""
+
+    def __init__(self, min_interval):
+        self.min_interval = min_interval
+        self._heap = []
+        self._jobs = {}
+        self._sequence = 0
+        self._cond = threading.Condition()
+        self._due = queue.Queue()
+        self._started = False
+
+    def add(self, job, now=None):
+        with self._cond:
+            # Повторный add заменяет задание: старая запись в куче просто игнорируется
+            self._jobs[job.job_id] = job
+            self._push(job, job.plan(time.time() if now is None else now))
+            self._cond.notify()
+
+    def remove(self, job_id):
+        with self._cond:
+            self._jobs.pop(job_id, None)
+
+    def jobs(self):
+        with self._cond:
+            return list(self._jobs.values())
+
+    def _push(self, job, when):
+        self._sequence += 1
+        heapq.heappush(self._heap, (when, self._sequence, job))
+
+    def start(self):
+        with self._cond:
+            if self._started:
+                return
+            self._started = True
+        threading.Thread(target=self._timer_loop, name='profile-timer', daemon=True).start()
+        threading.Thread(target=self._apply_loop, name='profile-apply', daemon=True).start()
+
+    def _timer_loop(self):
+        while True:
+            with self._cond:
+                while True:
+                    now = time.time()
+                    if self._heap and self._heap[0][0] <= now:
+                        break
+                    timeout = self._heap[0][0] - now if self._heap else None
+                    self._cond.wait(timeout)
+                when, _, job = heapq.heappop(self._heap)
+                if self._jobs.get(job.job_id) is not job or job.next_run != when:
+                    continue
+                self._push(job, job.plan(now))
+            self._due.put(job)
+
+    def _apply_loop(self):
+        while True:
+            job = self._due.get()
+            started = time.monotonic()
+            try:
+                job.last_result = apply_profile(job.chat_id, job.profile)
+            except Exception as e:
+                job.last_result = {'ok': False, 'description': str(e)}
+                settings_log.exception("❌ Scheduled job %s failed: %s", job.job_id, e)
+            else:
+                if not job.last_result.get('ok'):
+                    settings_log.error("❌ Scheduled job %s failed: %s", job.job_id, _Payload(job.last_result))
+            # Разносим вызовы Telegram, чтобы не упереться в лимиты
+            pause = self.min_interval - (time.monotonic() - started)
+            if pause > 0:
+                time.sleep(pause)
+
+def apply_profile(chat_id, name):
+    """Применяет именованный профиль (или пресет) к группе"""
+    profile = PERMISSION_PROFILES.get(name)
+    if profile is None:
+        preset = PERMISSION_PRESETS.get(name)
+        profile = preset['settings'] if preset else None
+    if profile is None:
+        return {'ok': False, 'description': f'Unknown profile: {name}'}
+    if chats.get(chat_id) is None:
+        return {'ok': False, 'description': f'Unknown chat: {chat_id}'}
+    settings_log.info("⏰ Applying profile %s to %s", name, chat_id)
+    return settings_batcher.submit(chat_id, profile, window=0)
+
+def load_schedule(path):
+    """Читает профили и задания из JSON-файла SCHEDULE_PATH"""
+    with open(path) as schedule_file:
+        config = json.load(schedule_file)
+    profiles = {}
+    for name, profile in (config.get('profiles') or {}).items():
+        if set(profile) != set(DEFAULT_SETTINGS):
+            raise ValueError(f"profile {name!r} must list exactly the keys {sorted(DEFAULT_SETTINGS)}")
+        profiles[name] = {key: bool(value) for key, value in profile.items()}
+    jobs = []
+    for index, entry in enumerate(config.get('schedules') or []):
+        targets = entry.get('chat_id', GROUP_CHAT_ID)
+        chat_ids = [state.chat_id for state in chats] if targets == 'all' else (
+            targets if isinstance(targets, list) else [targets])
+        job_id = entry.get('id', f"job{index}")
+        if entry['profile'] not in profiles and entry['profile'] not in PERMISSION_PRESETS:
+            raise ValueError(f"schedule {job_id!r} uses unknown profile {entry['profile']!r}")
+        for chat_id in chat_ids:
+            if chats.get(int(chat_id)) is None:
+                raise ValueError(f"schedule {job_id!r} targets chat {chat_id} that is not in GROUP_CHAT_IDS")
+            jobs.append(ScheduledJob(f"{job_id}:{chat_id}", int(chat_id), entry['profile'], entry['cron']))
+    return profiles, jobs
+
+PERMISSION_PROFILES = {}
+profile_scheduler = ProfileScheduler(SCHEDULE_MIN_INTERVAL)
+if SCHEDULE_PATH:
+    PERMISSION_PROFILES, _scheduled_jobs = load_schedule(SCHEDULE_PATH)
+    for _job in _scheduled_jobs:
+        profile_scheduler.add(_job)
+
+def start_scheduler():
+    """Запускает планировщик, если есть задания (один раз на процесс)"""
+    if SCHEDULER_ENABLED and BOT_TOKEN and profile_scheduler.jobs():
+        profile_scheduler.start()
+
+def prepare_request():
+    """Общая подготовка перед обработкой запроса (Flask и ASGI)"""
+    # Запускаем лениво на первом запросе: так поток переживёт fork воркеров
+    start_initial_sync()
+    start_scheduler()
+    refresh_shared_state()
+
+@app.before_request
+def _ensure_initial_sync():
+    g.request_started = time.perf_counter()
+    prepare_request()
+
+@app.after_request
+def _observe_request(response):
+    started = g.get('request_started')
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        http_request_duration.observe(time.perf_counter() - started,
+                                      route, request.method, response.status_code)
+    if request.path.startswith('/api/'):
+        response.headers['X-Telegram-Circuit'] = telegram_breaker.state
+    return response
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Метрики процесса в формате Prometheus"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/ready')
+def readiness():
+    """Проверка готовности без обращения к Telegram"""
+    synced_chats = sum(1 for state in chats if state.synced)
+    synced = synced_chats == len(chats)
+    status = 200
+    if not synced and request.args.get('require_sync', '').lower() in ('1', 'true', 'yes'):
+        status = 503
+    return jsonify({'ready': True, 'synced': synced, 'chats': len(chats),
+                    'synced_chats': synced_chats, 'restored_chats': restored_chats,
+                    'telegram_circuit': telegram_breaker.state}), status
 
 @app.route('/')
 def home():
@@ -143,277 +1835,61 @@ def home():
     </html>
     """
 
-@app.route('/settings')
-def settings_page():
-    """Главная страница настроек"""
-    return f"""
+# Статика мини-приложения: собирается один раз при старте, отдаётся по имени с хэшем
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+STATIC_MAX_AGE = 365 * 24 * 3600
+STATIC_TYPES = {'.css': 'text/css', '.js': 'application/javascript'}
+
+class StaticAsset:
+    """Файл из static/ с заранее сжатыми вариантами"""
+
+    def __init__(self, name, body):
+        stem, ext = os.path.splitext(name)
+        self.digest = hashlib.sha256(body).hexdigest()[:12]
+        self.url = f"/static/{stem}.{self.digest}{ext}"
+        self.mimetype = STATIC_TYPES.get(ext, 'application/octet-stream')
+        self.variants = {'identity': body}
+        # Сжатый вариант храним, только если он действительно меньше
+        compressed = gzip.compress(body, 9, mtime=0)
+        if len(compressed) < len(body):
+            self.variants['gzip'] = compressed
+        if brotli is not None:
+            compressed = brotli.compress(body, quality=11)
+            if len(compressed) < len(body):
+                self.variants['br'] = compressed
+
+    def encoding_for(self, accept_encodings):
+        """Лучший вариант из тех, что принимает клиент"""
+        for encoding in ('br', 'gzip'):
+            if encoding in self.variants and accept_encodings[encoding] > 0:
+                return encoding
+        return 'identity'
+
+def load_static_assets(directory=STATIC_DIR):
+    """Читает static/ и собирает варианты всех файлов"""
+    assets = {}
+    for name in sorted(os.listdir(directory)):
+        with open(os.path.join(directory, name), 'rb') as source:
+            assets[name] = StaticAsset(name, source.read())
+    return assets
+
+STATIC_ASSETS = load_static_assets()
+_STATIC_BY_URL = {asset.url: asset for asset in STATIC_ASSETS.values()}
+
+# Метка, на место которой подставляется JSON с текущими настройками и их версией
+_SETTINGS_PLACEHOLDER = '__CURRENT_SETTINGS__'
+
+# Статическая часть страницы настроек собирается один раз при старте
+_SETTINGS_PAGE_HTML = f"""
     <!DOCTYPE html>
     <html lang="ru">
     <head>
         <meta charset="UTF-8">
         <meta name="viewport" content="width=device-width, initial-scale=1.0">
         <title>Настройки приложения</title>
-        <script src="https://telegram.org/js/telegram-web-app.js"></script>
-        <style>
-            * {{
-                margin: 0;
-                padding: 0;
-                box-sizing: border-box;
-                font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, Oxygen, Ubuntu, Cantarell, sans-serif;
-            }}
-
-            body {{
-                background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-                min-height: 100vh;
-                padding: 10px;
-                display: flex;
-                justify-content: center;
-                align-items: flex-start;
-            }}
-
-            .container {{
-                width: 100%;
-                max-width: 500px;
-                background: rgba(255, 255, 255, 0.95);
-                border-radius: 20px;
-                box-shadow: 0 10px 30px rgba(0, 0, 0, 0.2);
-                overflow: hidden;
-                margin: 10px 0;
-            }}
-
-            .header {{
-                background: linear-gradient(90deg, #4f6df5, #3a56e8);
-                color: white;
-                padding: 20px;
-                text-align: center;
-            }}
-
-            .header h1 {{
-                font-size: 22px;
-                font-weight: 600;
-                margin-bottom: 5px;
-            }}
-
-            .header p {{
-                opacity: 0.9;
-                font-size: 14px;
-            }}
-
-            .settings-container {{
-                padding: 20px 15px;
-            }}
-
-            .section {{
-                margin-bottom: 25px;
-            }}
-
-            .section-title {{
-                font-size: 16px;
-                font-weight: 600;
-                color: #333;
-                margin-bottom: 15px;
-                padding-bottom: 8px;
-                border-bottom: 2px solid #4f6df5;
-                display: flex;
-                align-items: center;
-                gap: 8px;
-            }}
-
-            .setting-item {{
-                margin-bottom: 15px;
-                padding: 12px;
-                background: #f8f9fa;
-                border-radius: 10px;
-                transition: all 0.3s ease;
-            }}
-
-            .setting-item:hover {{
-                transform: translateY(-1px);
-                box-shadow: 0 2px 8px rgba(0,0,0,0.1);
-            }}
-
-            .setting-header {{
-                display: flex;
-                justify-content: space-between;
-                align-items: center;
-                margin-bottom: 6px;
-            }}
-
-            .setting-title {{
-                font-weight: 600;
-                color: #333;
-                font-size: 14px;
-                display: flex;
-                align-items: center;
-                gap: 8px;
-            }}
-
-            .setting-value {{
-                font-weight: 600;
-                color: #4f6df5;
-                font-size: 13px;
-            }}
-
-            .setting-description {{
-                color: #666;
-                font-size: 12px;
-                margin-top: 4px;
-                line-height: 1.3;
-            }}
-
-            .slider-container {{
-                position: relative;
-                height: 28px;
-                display: flex;
-                align-items: center;
-            }}
-
-            .buttons {{
-                display: flex;
-                gap: 10px;
-                margin-top: 25px;
-                flex-wrap: wrap;
-            }}
-
-            .btn {{
-                flex: 1;
-                min-width: 140px;
-                padding: 12px 15px;
-                border: none;
-                border-radius: 10px;
-                font-weight: 600;
-                font-size: 14px;
-                cursor: pointer;
-                transition: all 0.3s;
-                display: flex;
-                justify-content: center;
-                align-items: center;
-                gap: 6px;
-            }}
-
-            .btn-primary {{
-                background: linear-gradient(90deg, #4f6df5, #3a56e8);
-                color: white;
-                box-shadow: 0 3px 8px rgba(79, 109, 245, 0.3);
-            }}
-
-            .btn-primary:hover {{
-                transform: translateY(-1px);
-                box-shadow: 0 4px 12px rgba(79, 109, 245, 0.4);
-            }}
-
-            .btn-secondary {{
-                background: #f5f5f5;
-                color: #666;
-            }}
-
-            .btn-secondary:hover {{
-                background: #e9e9e9;
-            }}
-
-            .status {{
-                text-align: center;
-                margin-top: 15px;
-                padding: 10px;
-                border-radius: 8px;
-                font-size: 13px;
-                display: none;
-            }}
-
-            .status.success {{
-                background: #e8f5e9;
-                color: #2e7d32;
-                display: block;
-            }}
-
-            .status.error {{
-                background: #ffebee;
-                color: #c62828;
-                display: block;
-            }}
-
-            .status.info {{
-                background: #e3f2fd;
-                color: #1565c0;
-                display: block;
-            }}
-
-            .icon {{
-                width: 16px;
-                height: 16px;
-            }}
-
-            /* Switch styles */
-            .switch {{
-                position: relative;
-                display: inline-block;
-                width: 50px;
-                height: 28px;
-            }}
-
-            .switch input {{
-                opacity: 0;
-                width: 0;
-                height: 0;
-            }}
-
-            .switch-slider {{
-                position: absolute;
-                cursor: pointer;
-                top: 0;
-                left: 0;
-                right: 0;
-                bottom: 0;
-                background-color: #ccc;
-                transition: .4s;
-                border-radius: 28px;
-            }}
-
-            .switch-slider:before {{
-                position: absolute;
-                content: "";
-                height: 22px;
-                width: 22px;
-                left: 3px;
-                bottom: 3px;
-                background-color: white;
-                transition: .4s;
-                border-radius: 50%;
-            }}
-
-            input:checked + .switch-slider {{
-                background-color: #4f6df5;
-            }}
-
-            input:checked + .switch-slider:before {{
-                transform: translateX(22px);
-            }}
-
-            .emoji {{
-                font-size: 16px;
-            }}
-
-            @media (max-width: 480px) {{
-                .container {{
-                    margin: 5px;
-                    border-radius: 15px;
-                }}
-                
-                .header {{
-                    padding: 15px;
-                }}
-                
-                .settings-container {{
-                    padding: 15px 10px;
-                }}
-                
-                .btn {{
-                    min-width: 120px;
-                    font-size: 13px;
-                    padding: 10px 12px;
-                }}
-            }}
-        </style>
+        <link rel="stylesheet" href="{STATIC_ASSETS['settings.css'].url}">
+        <script src="https://telegram.org/js/telegram-web-app.js" defer></script>
+        <script src="{STATIC_ASSETS['settings.js'].url}" defer></script>
     </head>
     <body>
         <div class="container">
@@ -634,6 +2110,17 @@ def settings_page():
                     </div>
                 </div>
                 
+                <!-- Быстрые пресеты -->
+                <div class="section">
+                    <div class="section-title">
+                        <span class="emoji">⚡</span>
+                        Быстрые пресеты
+                    </div>
+                    <div class="buttons presets">
+                        {''.join(f'<button class="btn btn-secondary" onclick="applyPreset({chr(39)}{name}{chr(39)})">{preset["title"]}</button>' for name, preset in PERMISSION_PRESETS.items())}
+                    </div>
+                </div>
+
                 <div class="buttons">
                     <button class="btn btn-secondary" onclick="syncSettings()">
                         <svg class="icon" viewBox="0 0 24 24" fill="none" xmlns="http://www.w3.org/2000/svg">
@@ -653,236 +2140,621 @@ def settings_page():
             </div>
         </div>
 
-        <script>
-            // Текущие настройки
-            let currentSettings = {json.dumps(current_settings)};
-
-            // Загружаем настройки при загрузке страницы
-            document.addEventListener('DOMContentLoaded', function() {{
-                console.log('Initial settings:', currentSettings);
-                updateUI(currentSettings);
-                showStatus('✅ Настройки загружены', 'success');
-            }});
-
-            function updateUI(settings) {{
-                console.log('Updating UI with settings:', settings);
-                
-                // Основные разрешения
-                document.getElementById('can_send_messages').checked = settings.can_send_messages || false;
-                document.getElementById('can_send_polls').checked = settings.can_send_polls || false;
-                
-                // Медиафайлы
-                document.getElementById('can_send_media_messages').checked = settings.can_send_media_messages || false;
-                document.getElementById('can_send_photos').checked = settings.can_send_photos || false;
-                document.getElementById('can_send_videos').checked = settings.can_send_videos || false;
-                document.getElementById('can_send_video_notes').checked = settings.can_send_video_notes || false;
-                document.getElementById('can_send_voice_notes').checked = settings.can_send_voice_notes || false;
-                document.getElementById('can_send_stickers').checked = settings.can_send_stickers || false;
-                
-                // Управление группой
-                document.getElementById('can_change_info').checked = settings.can_change_info || false;
-                document.getElementById('can_invite_users').checked = settings.can_invite_users || false;
-                document.getElementById('can_pin_messages').checked = settings.can_pin_messages || false;
-                
-                // Обновляем статусы
-                document.getElementById('messages_status').textContent = settings.can_send_messages ? 'ON' : 'OFF';
-                document.getElementById('polls_status').textContent = settings.can_send_polls ? 'ON' : 'OFF';
-                document.getElementById('media_status').textContent = settings.can_send_media_messages ? 'ON' : 'OFF';
-                document.getElementById('photos_status').textContent = settings.can_send_photos ? 'ON' : 'OFF';
-                document.getElementById('videos_status').textContent = settings.can_send_videos ? 'ON' : 'OFF';
-                document.getElementById('video_notes_status').textContent = settings.can_send_video_notes ? 'ON' : 'OFF';
-                document.getElementById('voice_notes_status').textContent = settings.can_send_voice_notes ? 'ON' : 'OFF';
-                document.getElementById('stickers_status').textContent = settings.can_send_stickers ? 'ON' : 'OFF';
-                document.getElementById('info_status').textContent = settings.can_change_info ? 'ON' : 'OFF';
-                document.getElementById('invite_status').textContent = settings.can_invite_users ? 'ON' : 'OFF';
-                document.getElementById('pin_status').textContent = settings.can_pin_messages ? 'ON' : 'OFF';
-            }}
-
-            function toggleSetting(setting, value, statusElement) {{
-                console.log('Toggling setting:', setting, 'to:', value);
-                showStatus('🔄 Изменение настроек...', 'info');
-                
-                fetch('/api/update', {{
-                    method: 'POST',
-                    headers: {{
-                        'Content-Type': 'application/json',
-                    }},
-                    body: JSON.stringify({{
-                        setting: setting,
-                        value: value
-                    }})
-                }})
-                .then(response => {{
-                    if (!response.ok) {{
-                        throw new Error('Network response was not ok: ' + response.status);
-                    }}
-                    return response.json();
-                }})
-                .then(result => {{
-                    console.log('Update result:', result);
-                    if (result.success) {{
-                        currentSettings = result.settings;
-                        updateUI(currentSettings);
-                        showStatus('✅ Настройка применена!', 'success');
-                    }} else {{
-                        showStatus('❌ Ошибка: ' + result.error, 'error');
-                        // Возвращаем переключатель в предыдущее состояние
-                        document.getElementById(setting).checked = !value;
-                        document.getElementById(statusElement).textContent = !value ? 'ON' : 'OFF';
-                    }}
-                }})
-                .catch(error => {{
-                    console.error('Error updating setting:', error);
-                    showStatus('❌ Ошибка сети: ' + error.message, 'error');
-                    // Возвращаем переключатель в предыдущее состояние
-                    document.getElementById(setting).checked = !value;
-                    document.getElementById(statusElement).textContent = !value ? 'ON' : 'OFF';
-                }});
-            }}
-
-            function syncSettings() {{
-                showStatus('🔄 Синхронизация с Telegram...', 'info');
-                
-                fetch('/api/sync')
-                    .then(response => {{
-                        if (!response.ok) {{
-                            throw new Error('Network response was not ok: ' + response.status);
-                        }}
-                        return response.json();
-                    }})
-                    .then(result => {{
-                        console.log('Sync result:', result);
-                        if (result.success) {{
-                            currentSettings = result.settings;
-                            updateUI(currentSettings);
-                            showStatus('✅ Настройки синхронизированы!', 'success');
-                        }} else {{
-                            showStatus('❌ Ошибка синхронизации: ' + result.message, 'error');
-                        }}
-                    }})
-                    .catch(error => {{
-                        console.error('Error syncing settings:', error);
-                        showStatus('❌ Ошибка сети при синхронизации: ' + error.message, 'error');
-                    }});
-            }}
-
-            function applyAllSettings() {{
-                showStatus('🎯 Применение всех настроек...', 'info');
-                
-                fetch('/api/apply')
-                    .then(response => {{
-                        if (!response.ok) {{
-                            throw new Error('Network response was not ok: ' + response.status);
-                        }}
-                        return response.json();
-                    }})
-                    .then(result => {{
-                        console.log('Apply result:', result);
-                        if (result.success) {{
-                            showStatus('✅ Все настройки применены!', 'success');
-                        }} else {{
-                            showStatus('❌ Ошибка применения настроек: ' + result.message, 'error');
-                        }}
-                    }})
-                    .catch(error => {{
-                        console.error('Error applying settings:', error);
-                        showStatus('❌ Ошибка сети: ' + error.message, 'error');
-                    }});
-            }}
-
-            function showStatus(message, type) {{
-                const status = document.getElementById('status');
-                status.textContent = message;
-                status.className = 'status ' + type;
-                status.style.display = 'block';
-                
-                setTimeout(() => {{
-                    status.style.display = 'none';
-                }}, 3000);
-            }}
-
-            // Инициализация Telegram Web App
-            if (typeof Telegram !== 'undefined' && Telegram.WebApp) {{
-                Telegram.WebApp.ready();
-                Telegram.WebApp.expand();
-            }}
-        </script>
+        <script id="initial-settings" type="application/json">{_SETTINGS_PLACEHOLDER}</script>
+        <script id="presets" type="application/json">{json.dumps({name: preset['settings'] for name, preset in PERMISSION_PRESETS.items()})}</script>
     </body>
     </html>
     """
 
+_SETTINGS_PAGE_PREFIX, _SETTINGS_PAGE_SUFFIX = (
+    part.encode('utf-8') for part in _SETTINGS_PAGE_HTML.split(_SETTINGS_PLACEHOLDER))
+_SETTINGS_PAGE_HASH = hashlib.sha1(_SETTINGS_PAGE_HTML.encode('utf-8')).hexdigest()[:16]
+
+def _arg_flag(name):
+    """Читает булев флаг из query-параметров"""
+    return request.args.get(name, '').lower() in ('1', 'true', 'yes')
+
+def _request_chat():
+    """Возвращает состояние группы из параметра chat_id или None, если группа не управляется"""
+    raw = request.args.get('chat_id')
+    if raw is None and request.is_json:
+        raw = (request.get_json(silent=True) or {}).get('chat_id')
+    return chat_from_param(raw)
+
+def chat_from_param(raw):
+    """Состояние группы по значению chat_id из запроса; пустое - группа по умолчанию"""
+    if raw in (None, ''):
+        return chats.get(GROUP_CHAT_ID)
+    try:
+        return chats.get(int(raw))
+    except (TypeError, ValueError):
+        return None
+
+def update_response(state, result, message):
+    """Ответ /api/update и /api/update_batch"""
+    settings, revision, etag = state.versioned()
+    if result.get('ok'):
+        return {
+            'success': True,
+            'settings': settings,
+            'version': revision,
+            'etag': etag,
+            'skipped': result.get('skipped', False),
+            'message': message,
+            'telegram_circuit': telegram_breaker.state
+        }
+    if result.get('conflict'):
+        # Клиент получает актуальную версию и решает, повторять ли изменения
+        return {
+            'success': False,
+            'conflict': True,
+            'error': result['description'],
+            'settings': settings,
+            'version': revision,
+            'etag': etag,
+            'telegram_circuit': telegram_breaker.state
+        }
+    return {
+        'success': False,
+        'error': 'Telegram API error: ' + str(result.get('description', 'Unknown error')),
+        'settings': settings,
+        'version': revision,
+        'etag': etag,
+        'telegram_circuit': telegram_breaker.state
+    }
+
+def sync_response(state, success):
+    settings, revision, etag = state.versioned()
+    return {
+        'success': success,
+        'settings': settings,
+        'version': revision,
+        'etag': etag,
+        'message': 'Settings synced' if success else (
+            'Sync failed: Telegram API unavailable' if telegram_breaker.state == 'open' else 'Sync failed'),
+        'telegram_circuit': telegram_breaker.state
+    }
+
+def apply_response(state, result):
+    settings, revision, etag = state.versioned()
+    return {
+        'success': result.get('ok', False),
+        'settings': settings,
+        'version': revision,
+        'etag': etag,
+        'skipped': result.get('skipped', False),
+        'message': 'Settings applied' if result.get('ok') else 'Apply failed: ' + str(result.get('description', 'Unknown error')),
+        'telegram_circuit': telegram_breaker.state
+    }
+
+def response_status(body):
+    """HTTP-статус ответа с настройками: конфликт версий - 412"""
+    return 412 if body.get('conflict') else 200
+
+def _settings_json(body):
+    """JSON-ответ с ETag версии настроек"""
+    response = jsonify(body)
+    response.status_code = response_status(body)
+    response.set_etag(body['etag'])
+    return response
+
+def _if_match():
+    """ETags из If-Match или None, если запись безусловная"""
+    return request.if_match if request.if_match else None
+
+def _unknown_chat():
+    return jsonify({'success': False, 'error': 'Unknown chat'}), 404
+
+@app.route('/settings')
+def settings_page():
+    """Главная страница настроек"""
+    state = _request_chat()
+    if state is None:
+        return 'Unknown chat', 404
+    settings, revision, settings_etag = state.versioned()
+    settings_json = json.dumps({'settings': settings, 'version': revision, 'etag': settings_etag}).encode('utf-8')
+    encoding = 'gzip' if request.accept_encodings['gzip'] > 0 else 'identity'
+    # Как у статики: у каждого кодирования свой ETag
+    etag = f"{_SETTINGS_PAGE_HASH}-{settings_etag}-{encoding}"
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        body = _SETTINGS_PAGE_PREFIX + settings_json + _SETTINGS_PAGE_SUFFIX
+        response = Response(mimetype='text/html')
+        if encoding == 'gzip':
+            # Страница своя для каждого состояния настроек - сжимаем на лету, быстро
+            body = gzip.compress(body, 6)
+            response.headers['Content-Encoding'] = 'gzip'
+        response.set_data(body)
+    response.set_etag(etag)
+    # Страница зависит от настроек, поэтому кэш всегда перепроверяется по ETag
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+@app.route('/static/<filename>')
+def static_asset(filename):
+    """Статика мини-приложения: неизменяемая, кэшируется навсегда"""
+    asset = _STATIC_BY_URL.get(request.path)
+    if asset is None:
+        return 'Not found', 404
+    encoding = asset.encoding_for(request.accept_encodings)
+    etag = f"{asset.digest}-{encoding}"
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(asset.variants[encoding], mimetype=asset.mimetype)
+        if encoding != 'identity':
+            response.headers['Content-Encoding'] = encoding
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = f'public, max-age={STATIC_MAX_AGE}, immutable'
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
 # API endpoints
 @app.route('/api/settings')
 def api_get_settings():
     """Возвращает текущие настройки"""
-    print(f"📊 API: Getting current settings: {current_settings}")
-    return jsonify(current_settings)
+    state = _request_chat()
+    if state is None:
+        return _unknown_chat()
+    settings, _, etag = state.versioned()
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        api_log.debug("📊 API: Getting current settings for %s: %s", state.chat_id, _Payload(settings))
+        response = jsonify(settings)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
 
 @app.route('/api/update', methods=['POST'])
 def api_update_setting():
     """Обновляет одну настройку"""
     try:
+        state = _request_chat()
+        if state is None:
+            return _unknown_chat()
         data = request.get_json()
         setting = data.get('setting')
         value = bool(data.get('value'))
         
-        print(f"🔄 API: Updating {setting} to {value}")
+        api_log.info("🔄 API: Updating %s to %s in %s", setting, value, state.chat_id)
         
-        if setting not in current_settings:
-            print(f"❌ API: Invalid setting: {setting}")
+        if setting not in DEFAULT_SETTINGS:
+            api_log.warning("❌ API: Invalid setting: %s", setting)
             return jsonify({'success': False, 'error': 'Invalid setting'})
         
-        result = update_setting(setting, value)
+        result = update_setting(state.chat_id, setting, value, expected=_if_match())
         
         if result.get('ok'):
-            print(f"✅ API: Successfully updated {setting}")
-            return jsonify({
-                'success': True, 
-                'settings': current_settings,
-                'message': f'{setting} set to {value}'
-            })
+            api_log.info("✅ API: Successfully updated %s", setting)
+        elif result.get('conflict'):
+            api_log.info("🔀 API: Version conflict for %s in %s", setting, state.chat_id)
         else:
-            print(f"❌ API: Telegram API error for {setting}")
-            return jsonify({
-                'success': False, 
-                'error': 'Telegram API error: ' + str(result.get('description', 'Unknown error')),
-                'settings': current_settings
-            })
+            api_log.warning("❌ API: Telegram API error for %s", setting)
+        return _settings_json(update_response(state, result, f'{setting} set to {value}'))
             
     except Exception as e:
-        print(f"❌ API: Exception: {e}")
+        api_log.exception("❌ API: Exception: %s", e)
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/api/update_batch', methods=['POST'])
+def api_update_settings_batch():
+    """Обновляет несколько настроек одним setChatPermissions"""
+    try:
+        state = _request_chat()
+        if state is None:
+            return _unknown_chat()
+        data = request.get_json() or {}
+        changes, error = validate_settings(data.get('settings'))
+        if error:
+            api_log.warning("❌ API: Invalid batch for %s: %s", state.chat_id, error)
+            return jsonify({'success': False, 'error': error}), 400
+
+        api_log.info("🔄 API: Updating %d settings in %s", len(changes), state.chat_id)
+        result = update_settings(state.chat_id, changes, expected=_if_match())
+        return _settings_json(update_response(state, result, f'{len(changes)} settings updated'))
+    except Exception as e:
+        api_log.exception("❌ API: Batch exception: %s", e)
         return jsonify({'success': False, 'error': str(e)})
 
 @app.route('/api/sync')
 def api_sync_settings():
     """Синхронизирует настройки с Telegram"""
     try:
-        print("🔄 API: Syncing settings with Telegram")
-        success = sync_settings()
-        return jsonify({
-            'success': success,
-            'settings': current_settings,
-            'message': 'Settings synced' if success else 'Sync failed'
-        })
+        state = _request_chat()
+        if state is None:
+            return _unknown_chat()
+        fresh = _arg_flag('fresh')
+        api_log.info("🔄 API: Syncing settings for %s with Telegram (fresh=%s)", state.chat_id, fresh)
+        success = sync_settings(state.chat_id, fresh=fresh)
+        return _settings_json(sync_response(state, success))
     except Exception as e:
-        print(f"❌ API: Sync exception: {e}")
+        api_log.exception("❌ API: Sync exception: %s", e)
         return jsonify({'success': False, 'error': str(e)})
 
 @app.route('/api/apply')
 def api_apply_settings():
     """Применяет все текущие настройки"""
     try:
-        print("🎯 API: Applying all settings")
-        result = apply_settings()
-        return jsonify({
-            'success': result.get('ok', False),
-            'settings': current_settings,
-            'message': 'Settings applied' if result.get('ok') else 'Apply failed: ' + str(result.get('description', 'Unknown error'))
-        })
+        state = _request_chat()
+        if state is None:
+            return _unknown_chat()
+        force = _arg_flag('force')
+        api_log.info("🎯 API: Applying all settings to %s (force=%s)", state.chat_id, force)
+        with state.apply_lock:
+            result = apply_settings(state.chat_id, force=force)
+        return _settings_json(apply_response(state, result))
     except Exception as e:
-        print(f"❌ API: Apply exception: {e}")
+        api_log.exception("❌ API: Apply exception: %s", e)
         return jsonify({'success': False, 'error': str(e)})
 
+@app.route('/api/schedules')
+def api_schedules():
+    """Профили разрешений и запланированные задания"""
+    return jsonify({
+        'profiles': PERMISSION_PROFILES,
+        'presets': {name: preset['settings'] for name, preset in PERMISSION_PRESETS.items()},
+        'jobs': [{
+            'id': job.job_id,
+            'chat_id': job.chat_id,
+            'profile': job.profile,
+            'cron': job.cron.expression,
+            'next_run': datetime.fromtimestamp(job.next_run).isoformat() if job.next_run else None,
+            'last_ok': job.last_result.get('ok') if job.last_result else None,
+        } for job in profile_scheduler.jobs()],
+    })
+
+@app.route('/api/stream')
+def api_stream_settings():
+    """Поток снимков настроек группы (Server-Sent Events)"""
+    state = _request_chat()
+    if state is None:
+        return _unknown_chat()
+    events = settings_broadcaster.subscribe(state.chat_id)
+    if events is None:
+        return jsonify({'success': False, 'error': 'Too many stream clients'}), 503
+
+    def generate():
+        try:
+            with state.lock:
+                initial = json.dumps({'settings': state.settings, 'version': state.revision,
+                                      'etag': state._etag()})
+            yield f"retry: 3000\nevent: settings\ndata: {initial}\n\n"
+            while True:
+                try:
+                    message = events.get(timeout=SSE_HEARTBEAT)
+                except queue.Empty:
+                    # Комментарий держит соединение живым через прокси
+                    refresh_shared_state()
+                    yield ": ping\n\n"
+                    continue
+                yield f"event: settings\ndata: {message}\n\n"
+        finally:
+            settings_broadcaster.unsubscribe(state.chat_id, events)
+
+    response = Response(generate(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+# Типы обновлений, которые Telegram вообще присылает боту (вебхук и getUpdates)
+ALLOWED_UPDATES = [
+    name.strip() for name in os.environ.get(
+        'ALLOWED_UPDATES', os.environ.get('POLLING_ALLOWED_UPDATES', 'message')).split(',')
+    if name.strip()
+]
+# Отбросить накопившиеся обновления при установке вебхука
+WEBHOOK_DROP_PENDING_UPDATES = os.environ.get('WEBHOOK_DROP_PENDING_UPDATES', '').lower() in ('1', 'true', 'yes')
+BOT_COMMANDS = ('/start', '/settings')
+
+def _reject_reason(data):
+    """Быстрая проверка до разбора и логирования; None - обновление нужно обработать"""
+    message = data.get('message') if isinstance(data, dict) else None
+    if not isinstance(message, dict):
+        return 'ignored'
+    if (message.get('from') or {}).get('id') not in ALLOWED_USER_IDS:
+        return 'unauthorized'
+    if not message.get('text', '').startswith(BOT_COMMANDS):
+        return 'ignored'
+    return None
+
+# Защита от повторной доставки одного и того же обновления
+UPDATE_DEDUP_SIZE = int(os.environ.get('UPDATE_DEDUP_SIZE', 10000))
+UPDATE_DEDUP_TTL = float(os.environ.get('UPDATE_DEDUP_TTL', 3600))
+
+class UpdateDeduplicator:
+    """Ограниченный LRU из последних update_id с истечением по времени"""
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # update_id -> время получения; порядок вставки совпадает с порядком времени
+        self._seen = OrderedDict()
+
+    def seen(self, update_id):
+        """Запоминает update_id; возвращает True, если он уже приходил"""
+        if update_id is None or self.size <= 0:
+            return False
+        now = time.monotonic()
+        with self._lock:
+            # Самые старые записи в начале - выкидываем истёкшие
+            while self._seen:
+                oldest_id, received = next(iter(self._seen.items()))
+                if now - received < self.ttl:
+                    break
+                del self._seen[oldest_id]
+            duplicate = update_id in self._seen
+            if not duplicate:
+                if len(self._seen) >= self.size:
+                    self._seen.popitem(last=False)
+                self._seen[update_id] = now
+        updates_received.inc('duplicate' if duplicate else 'new')
+        return duplicate
+
+    def forget(self, update_id):
+        """Убирает update_id, чтобы повторная доставка обработалась (обновление не принято)"""
+        with self._lock:
+            self._seen.pop(update_id, None)
+
+    def __len__(self):
+        return len(self._seen)
+
+updates_received = metrics.register(Counter(
+    'donk_updates_received_total', 'Updates received from Telegram by filtering and deduplication result', ('result',)))
+update_dedup = UpdateDeduplicator(UPDATE_DEDUP_SIZE, UPDATE_DEDUP_TTL)
+metrics.register(Gauge('donk_update_dedup_size', 'update_id values remembered for deduplication',
+                       lambda: len(update_dedup)))
+
+# Очередь обработки обновлений от Telegram
+WEBHOOK_WORKERS = int(os.environ.get('WEBHOOK_WORKERS', 4))
+WEBHOOK_QUEUE_SIZE = int(os.environ.get('WEBHOOK_QUEUE_SIZE', 1000))
+# drop_oldest - вытесняем самое старое, drop_newest - отбрасываем новое,
+# reject - отвечаем 503, чтобы Telegram доставил обновление повторно
+WEBHOOK_OVERFLOW = os.environ.get('WEBHOOK_OVERFLOW', 'drop_oldest')
+WEBHOOK_DRAIN_TIMEOUT = float(os.environ.get('WEBHOOK_DRAIN_TIMEOUT', 10))
+
+def handle_update(data, host):
+    """Обрабатывает одно обновление от Telegram"""
+    reply = update_reply(data, host)
+    if reply is not None:
+        telegram_api('sendMessage', reply)
+
+def update_reply(data, host):
+    """Ответ бота на обновление (параметры sendMessage) или None"""
+    # Обрабатываем сообщения
+    if 'message' in data:
+        message = data['message']
+        user_id = message['from']['id']
+        chat_id = message['chat']['id']
+
+        # Проверяем доступ
+        if user_id not in ALLOWED_USER_IDS:
+            # Не отправляем сообщение - просто логируем
+            webhook_log.info("🚫 Access denied for user %s", user_id)
+            return None
+
+        # Обрабатываем команды
+        if 'text' in message:
+            text = message['text']
+
+            command, _, argument = text.partition(' ')
+            if command in BOT_COMMANDS:
+                # В группе открываем её настройки, в личке - группу из аргумента или по умолчанию
+                target = chat_id if chats.get(chat_id) is not None else GROUP_CHAT_ID
+                if argument.strip().lstrip('-').isdigit() and chats.get(int(argument)) is not None:
+                    target = int(argument)
+                webapp_url = f"https://{host}/settings?chat_id={target}"
+
+                # Сообщение с кнопкой для открытия мини-приложения
+                return {
+                    'chat_id': chat_id,
+                    'text': '🎛️ *Donk Chat Settings*\n\nУправление настройками группы',
+                    'parse_mode': 'Markdown',
+                    'reply_markup': {
+                        'inline_keyboard': [[
+                            {
+                                'text': '⚙️ Открыть настройки',
+                                'web_app': {'url': webapp_url}
+                            }
+                        ]]
+                    }
+                }
+    return None
+
+class UpdateQueue:
+    """Ограниченная очередь обновлений с пулом рабочих потоков"""
+
+    def __init__(self, workers, maxsize, overflow):
+        self.workers = workers
+        self.overflow = overflow
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._threads = []
+        self._lock = threading.Lock()
+        self._closed = False
+        self.dropped = 0
+
+    def _start(self):
+        """Запускает рабочие потоки при первом обращении"""
+        with self._lock:
+            if self._threads or self._closed:
+                return
+            for n in range(self.workers):
+                thread = threading.Thread(target=self._worker, name=f'update-worker-{n}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            atexit.register(self.shutdown)
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                handle_update(*item)
+            except Exception as e:
+                webhook_log.exception("❌ Update handling error: %s", e)
+            finally:
+                self._queue.task_done()
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def submit(self, data, host, block=False):
+        """Ставит обновление в очередь, возвращает False, если оно не принято"""
+        if self._closed:
+            return False
+        if not self._threads:
+            self._start()
+        item = (data, host)
+        try:
+            # block=True - ждём места в очереди (обратное давление для long polling)
+            self._queue.put(item, block=block)
+            return True
+        except queue.Full:
+            pass
+
+        self.dropped += 1
+        if self.overflow == 'drop_oldest':
+            try:
+                self._queue.get_nowait()
+                self._queue.task_done()
+            except queue.Empty:
+                pass
+            try:
+                self._queue.put_nowait(item)
+                webhook_log.warning("⚠️ Update queue full, dropped oldest update")
+                return True
+            except queue.Full:
+                pass
+        webhook_log.warning("⚠️ Update queue full (%s), update not accepted", self.overflow)
+        # При drop_newest Telegram повторять не нужно - обновление просто теряется
+        return self.overflow == 'drop_newest'
+
+    def shutdown(self, timeout=WEBHOOK_DRAIN_TIMEOUT):
+        """Дожидается обработки очереди и останавливает рабочие потоки"""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        if not self._threads:
+            return
+        webhook_log.info("🛑 Draining update queue (%d pending)", self.depth())
+        deadline = time.monotonic() + timeout
+        for _ in self._threads:
+            try:
+                self._queue.put(None, timeout=max(0.01, deadline - time.monotonic()))
+            except queue.Full:
+                break
+        for thread in self._threads:
+            thread.join(max(0, deadline - time.monotonic()))
+
+update_queue = UpdateQueue(WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE, WEBHOOK_OVERFLOW)
+metrics.register(Gauge('donk_webhook_queue_depth', 'Updates waiting for a worker', update_queue.depth))
+metrics.register(Gauge('donk_webhook_dropped_total', 'Updates dropped because the queue was full',
+                       lambda: update_queue.dropped, kind='counter'))
+metrics.register(Gauge('donk_log_dropped_total', 'Log records dropped because the log queue was full',
+                       lambda: _log_handler.dropped, kind='counter'))
+metrics.register(Gauge('donk_sse_clients', 'Open settings stream connections',
+                       lambda: settings_broadcaster.clients))
+
+# Получение обновлений через long polling (getUpdates) вместо вебхука
+BOT_MODE = os.environ.get('BOT_MODE', 'webhook')
+PUBLIC_HOST = os.environ.get('HOST', 'donkchatbot.onrender.com')
+POLLING_TIMEOUT = int(os.environ.get('POLLING_TIMEOUT', 30))
+POLLING_LIMIT = int(os.environ.get('POLLING_LIMIT', 100))
+
+class UpdatePoller:
+    """Забирает обновления через getUpdates и передаёт их в очередь обработки"""
+
+    def __init__(self, updates, host, timeout=POLLING_TIMEOUT, limit=POLLING_LIMIT,
+                 allowed_updates=ALLOWED_UPDATES):
+        self.updates = updates
+        self.host = host
+        self.timeout = timeout
+        self.limit = limit
+        self.allowed_updates = allowed_updates
+        self.offset = None
+        self.received = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def poll_once(self):
+        """Один запрос getUpdates; возвращает число принятых обновлений или None при ошибке"""
+        params = {
+            'timeout': self.timeout,
+            'limit': self.limit,
+            'allowed_updates': self.allowed_updates,
+        }
+        if self.offset is not None:
+            params['offset'] = self.offset
+        result = telegram_api('getUpdates', params, read_timeout=self.timeout + TELEGRAM_READ_TIMEOUT)
+        if not result.get('ok'):
+            if result.get('error_code') == 409:
+                # getUpdates не работает, пока установлен вебхук
+                webhook_log.warning("⚠️ Webhook is active, deleting it for polling mode")
+                telegram_api('deleteWebhook', {})
+            return None
+        for update in result.get('result', []):
+            self.offset = update['update_id'] + 1
+            reason = _reject_reason(update)
+            if reason is not None:
+                updates_received.inc(reason)
+                continue
+            if update_dedup.seen(update['update_id']):
+                continue
+            self.updates.submit(update, self.host, block=True)
+        self.received += len(result.get('result', []))
+        return len(result.get('result', []))
+
+    def run(self):
+        """Цикл опроса до вызова stop()"""
+        webhook_log.info("📥 Polling started (timeout=%s, limit=%s, allowed_updates=%s)",
+                         self.timeout, self.limit, self.allowed_updates)
+        telegram_api('deleteWebhook', {})
+        failures = 0
+        while not self._stop.is_set():
+            try:
+                count = self.poll_once()
+            except Exception as e:
+                webhook_log.exception("❌ Polling error: %s", e)
+                count = None
+            if count is None:
+                failures += 1
+                self._stop.wait(min(TELEGRAM_RETRY_BACKOFF * (2 ** failures), 30))
+            else:
+                failures = 0
+        webhook_log.info("📥 Polling stopped after %d updates", self.received)
+
+    def start(self):
+        """Запускает опрос в фоновом потоке"""
+        self._thread = threading.Thread(target=self.run, name='update-poller', daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+        return self._thread
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout)
+
+def accept_update(data):
+    """Фильтр вебхука: False - обновление отброшено (чужое, ненужное или повтор)"""
+    # Чужие и ненужные обновления отбрасываем до логирования и очереди
+    reason = _reject_reason(data)
+    if reason is not None:
+        updates_received.inc(reason)
+        return False
+    update_id = data.get('update_id')
+    # Повторная доставка - отвечаем OK, ничего не делая
+    if update_dedup.seen(update_id):
+        webhook_log.debug("🔁 Duplicate update %s ignored", update_id)
+        return False
+    webhook_log.info("🤖 Webhook received: %s", _Payload(data))
+    return True
+
 # Webhook для обработки команд бота
 @app.route('/webhook', methods=['POST'])
 def bot_webhook():
@@ -892,44 +2764,14 @@ def bot_webhook():
     
     try:
         data = request.get_json()
-        print(f"🤖 Webhook received: {data}")
-        
-        # Обрабатываем сообщения
-        if 'message' in data:
-            message = data['message']
-            user_id = message['from']['id']
-            chat_id = message['chat']['id']
-            
-            # Проверяем доступ
-            if user_id not in ALLOWED_USER_IDS:
-                # Не отправляем сообщение - просто логируем
-                print(f"🚫 Access denied for user {user_id}")
-                return 'OK'
-            
-            # Обрабатываем команды
-            if 'text' in message:
-                text = message['text']
-                
-                if text == '/start' or text == '/settings':
-                    webapp_url = f"https://{request.host}/settings"
-                    
-                    # Отправляем сообщение с кнопкой для открытия мини-приложения
-                    telegram_api('sendMessage', {
-                        'chat_id': chat_id,
-                        'text': '🎛️ *Donk Chat Settings*\n\nУправление настройками группы',
-                        'parse_mode': 'Markdown',
-                        'reply_markup': {
-                            'inline_keyboard': [[
-                                {
-                                    'text': '⚙️ Открыть настройки',
-                                    'web_app': {'url': webapp_url}
-                                }
-                            ]]
-                        }
-                    })
-        
+        if not accept_update(data):
+            return 'OK'
+        if not update_queue.submit(data, request.host):
+            # Telegram пришлёт обновление снова - оно не должно считаться дублем
+            update_dedup.forget(data.get('update_id'))
+            return 'Queue full', 503
     except Exception as e:
-        print(f"❌ Webhook error: {e}")
+        webhook_log.exception("❌ Webhook error: %s", e)
     
     return 'OK'
 
@@ -941,11 +2783,18 @@ def set_webhook():
         return 'BOT_TOKEN not set'
     
     webhook_url = f"https://{request.host}/webhook"
-    result = telegram_api('setWebhook', {'url': webhook_url})
+    drop_pending = _arg_flag('drop_pending') or WEBHOOK_DROP_PENDING_UPDATES
+    result = telegram_api('setWebhook', {
+        'url': webhook_url,
+        'allowed_updates': ALLOWED_UPDATES,
+        'drop_pending_updates': drop_pending
+    })
     
     return jsonify({
         'success': result.get('ok', False),
         'webhook_url': webhook_url,
+        'allowed_updates': ALLOWED_UPDATES,
+        'drop_pending_updates': drop_pending,
         'result': result
     })
 
@@ -963,17 +2812,21 @@ def delete_webhook():
     })
 
 if __name__ == '__main__':
-    print("🚀 Starting Group Settings Manager")
-    print(f"🎯 Group: {GROUP_CHAT_ID}")
-    print(f"👥 Allowed users: {ALLOWED_USER_IDS}")
-    print(f"📊 Initial settings: {current_settings}")
-    print(f"🔑 BOT_TOKEN: {'Set' if BOT_TOKEN else 'Not set!'}")
+    app_log.info("🚀 Starting Group Settings Manager")
+    app_log.info("🎯 Groups: %s (default %s)", GROUP_CHAT_IDS, GROUP_CHAT_ID)
+    app_log.info("👥 Allowed users: %s", sorted(ALLOWED_USER_IDS))
+    app_log.info("📊 Initial settings: %s", DEFAULT_SETTINGS)
+    app_log.info("🔑 BOT_TOKEN: %s", 'Set' if BOT_TOKEN else 'Not set!')
     
     # Автоматически устанавливаем вебхук при запуске
-    if BOT_TOKEN:
-        webhook_url = f"https://{os.environ.get('HOST', 'https://donkchatbot.onrender.com')}/webhook"
-        print(f"🌐 Webhook URL: {webhook_url}")
-        print("💡 Use /set_webhook to set webhook manually")
+    if BOT_TOKEN and (BOT_MODE == 'polling' or '--polling' in sys.argv):
+        UpdatePoller(update_queue, PUBLIC_HOST).start()
+    elif BOT_TOKEN:
+        webhook_url = f"https://{PUBLIC_HOST}/webhook"
+        app_log.info("🌐 Webhook URL: %s", webhook_url)
+        app_log.info("💡 Use /set_webhook to set webhook manually")
     
+    start_initial_sync()
+    start_scheduler()
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port)
@@ -0,0 +1,459 @@
+"""Асинхронный (ASGI) режим для маршрутов, которые ждут Telegram.
+
+/webhook, /api/update, /api/update_batch, /api/sync и /api/apply ждут Telegram
+через асинхронный HTTP-клиент (httpx) и не занимают поток на время вызова,
+поэтому один процесс держит сотни одновременных запросов к Bot API. Остальные
+маршруты обслуживает то же Flask-приложение через a2wsgi. Ответы и логика
+совпадают с app.py: общие состояния, кэш getChat, лимиты диспетчера и хранилище.
+
+    uvicorn asgi:app --host 0.0.0.0 --port 5000
+"""
+from urllib.parse import parse_qs
+from a2wsgi import WSGIMiddleware
+from werkzeug.http import parse_etags, quote_etag
+import asyncio
+import contextlib
+import json
+import os
+import time
+import httpx
+import app as core
+
+ASGI_TELEGRAM_CONNECTIONS = int(os.environ.get('ASGI_TELEGRAM_CONNECTIONS', 200))
+# Потоки для маршрутов Flask, которые остаются синхронными; каждый поток SSE держит один
+ASGI_WSGI_THREADS = int(os.environ.get('ASGI_WSGI_THREADS', core.SSE_MAX_CLIENTS + 10))
+
+class AsyncTelegramClient:
+    """Неблокирующий клиент Bot API с теми же повторами, лимитами и метриками, что и telegram_api()"""
+
+    def __init__(self, connections):
+        self.connections = connections
+        self._client = None
+        self._flights = {}
+        self._tasks = set()
+        # Сколько вызовов каждого класса ждут токена - более важные идут первыми
+        self._waiting = [0] * len(core.PRIORITY_CLASSES)
+
+    def _http(self):
+        # Клиент создаётся внутри работающего event loop
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=self.connections,
+                                    max_keepalive_connections=self.connections),
+                timeout=httpx.Timeout(core.TELEGRAM_READ_TIMEOUT, connect=core.TELEGRAM_CONNECT_TIMEOUT))
+        return self._client
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def spawn(self, coroutine):
+        """Запускает задачу в фоне и держит ссылку на неё до завершения"""
+        task = asyncio.ensure_future(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def request(self, method, data, read_timeout=None):
+        """Прямой вызов Telegram Bot API (аналог _telegram_request)"""
+        url = f"{core.TELEGRAM_API_URL}/bot{core.BOT_TOKEN}/{method}"
+        timeout = httpx.Timeout(read_timeout or core.TELEGRAM_READ_TIMEOUT, connect=core.TELEGRAM_CONNECT_TIMEOUT)
+        core.telegram_log.debug("📡 API: %s -> %s", method, core._Payload(data))
+        body = ({'content': data.encoded, 'headers': core.JSON_HEADERS}
+                if isinstance(data, core.PreparedBody) else {'json': data})
+        attempt = 0
+        while True:
+            if core.TELEGRAM_BREAKER and not core.telegram_breaker.allow():
+                return core.telegram_breaker.rejected(method)
+            started = time.monotonic()
+            core.telegram_in_flight.inc()
+            try:
+                response = await self._http().post(url, timeout=timeout, **body)
+                try:
+                    result = response.json()
+                except ValueError:
+                    result = {'ok': False, 'error_code': response.status_code,
+                              'description': f'HTTP {response.status_code}'}
+            except (httpx.ConnectError, httpx.RemoteProtocolError) as e:
+                # Обрыв соединения (например, протухший keep-alive) - повторяем с паузой
+                result = {'ok': False, 'description': f'Connection error: {e}'}
+                delay = min(core.TELEGRAM_RETRY_BACKOFF * (2 ** attempt), core.TELEGRAM_MAX_RETRY_DELAY)
+            except Exception as e:
+                core._record_failure(method, started, e)
+                return {'ok': False, 'description': str(e) or type(e).__name__}
+            else:
+                delay = None if result.get('ok') else core._retry_delay(result, attempt)
+
+            core._record_attempt(method, started, result, attempt)
+            if result.get('ok') or delay is None or attempt >= core.TELEGRAM_MAX_RETRIES:
+                return result
+            attempt += 1
+            core.telegram_log.info("⏳ Retrying %s in %.1f s", method, delay)
+            await asyncio.sleep(delay)
+
+    async def _reserve(self, priority, chat_id):
+        """Ждёт токенов общего с потоками диспетчера лимита; возвращает время ожидания"""
+        level = core.PRIORITY_CLASSES[priority]
+        started = time.monotonic()
+        self._waiting[level] += 1
+        try:
+            while True:
+                if any(self._waiting[:level]):
+                    delay = 1 / core.OUTBOUND_GLOBAL_RATE
+                else:
+                    delay = core.outbound_dispatcher.reserve(priority, chat_id)
+                if delay == 0:
+                    return time.monotonic() - started
+                await asyncio.sleep(delay)
+        finally:
+            self._waiting[level] -= 1
+
+    async def _limited(self, method, data, read_timeout, priority):
+        waited = await self._reserve(priority, data.get('chat_id'))
+        core.outbound_wait.observe(waited, method)
+        result = dict(await self.request(method, data, read_timeout))
+        result['expected_wait'] = round(waited, 3)
+        return result
+
+    async def call(self, method, data, read_timeout=None, priority=None, wait=None):
+        """Вызов через лимиты и приоритеты (аналог telegram_api)"""
+        if core.TELEGRAM_BREAKER and core.telegram_breaker.retry_in() > 0:
+            return core.telegram_breaker.rejected(method)
+        if not core.OUTBOUND_DISPATCHER or method in core.DISPATCHER_BYPASS:
+            return await self.request(method, data, read_timeout)
+        priority = priority or core.METHOD_PRIORITIES.get(method, 'read')
+        if wait is None:
+            wait = priority not in core.OUTBOUND_FIRE_AND_FORGET
+        if not wait:
+            self.spawn(self._limited(method, data, read_timeout, priority))
+            return {'ok': True, 'queued': True}
+        return await self._limited(method, data, read_timeout, priority)
+
+    def _fetch_chat(self, chat_id):
+        """Один запрос getChat на группу, сколько бы корутин его ни ждали"""
+        flight = self._flights.get(chat_id)
+        if flight is None:
+            generation = core.chat_info_cache.generation(chat_id)
+            task = self.spawn(self.call('getChat', {'chat_id': chat_id}))
+            flight = self._flights[chat_id] = (task, generation)
+
+            def finished(task):
+                self._flights.pop(chat_id, None)
+                if not task.cancelled() and task.exception() is None:
+                    core.chat_info_cache.store(chat_id, generation, task.result())
+            task.add_done_callback(finished)
+        return flight
+
+    async def get_chat(self, chat_id, fresh=False):
+        """(ответ getChat, поколение кэша) через общий кэш (аналог chat_info_cache.get_versioned)"""
+        if not fresh:
+            result, stale, generation = core.chat_info_cache.lookup(chat_id)
+            if result is not None:
+                if stale:
+                    self._fetch_chat(chat_id)
+                return result, generation
+        task, generation = self._fetch_chat(chat_id)
+        # shield: отключившийся клиент не отменяет запрос, который ждут другие
+        return await asyncio.shield(task), generation
+
+telegram = AsyncTelegramClient(ASGI_TELEGRAM_CONNECTIONS)
+
+# chat_id -> asyncio.Lock: асинхронные вызовы одной группы ждут друг друга на event loop
+_apply_locks = {}
+
+@contextlib.asynccontextmanager
+async def _apply_lock(state):
+    """Держит apply_lock группы, не блокируя event loop: поток нужен, только если lock
+    занят синхронным кодом (планировщик, маршруты Flask), и берётся один раз на владельца"""
+    async with _apply_locks.setdefault(state.chat_id, asyncio.Lock()):
+        if not state.apply_lock.acquire(blocking=False):
+            acquiring = asyncio.ensure_future(asyncio.to_thread(state.apply_lock.acquire))
+            try:
+                await asyncio.shield(acquiring)
+            except asyncio.CancelledError:
+                # Поток всё равно возьмёт lock - отпускаем его сразу, как только возьмёт
+                acquiring.add_done_callback(lambda _: state.apply_lock.release())
+                raise
+        try:
+            yield
+        finally:
+            state.apply_lock.release()
+
+async def _off_loop(function, *args):
+    """Вызов, который сохраняет состояние: в общем режиме (SHARED_STATE) save() сразу пишет
+    в SQLite и может ждать блокировку до 5 с - такой вызов уводим с event loop в поток"""
+    if core.settings_store.shared:
+        return await asyncio.to_thread(function, *args)
+    return function(*args)
+
+async def apply_settings(chat_id, force=False):
+    """Асинхронный apply_settings()"""
+    state = core.chats.get(chat_id)
+    await _off_loop(core.refresh_shared_state)
+    mask = core._apply_snapshot(state, force)
+    if mask is None:
+        return {'ok': True, 'result': True, 'skipped': True}
+    try:
+        result = await telegram.call('setChatPermissions', core.permissions_request(chat_id, mask))
+    except asyncio.CancelledError:
+        # Без ответа не сохраняем ничего, но отметку об идущей отправке снимаем
+        core._apply_finished(state, mask, {'ok': False, 'description': 'Cancelled'})
+        raise
+    except Exception as e:
+        result = {'ok': False, 'description': str(e)}
+    await _off_loop(core._apply_finished, state, mask, result)
+    return result
+
+async def submit_settings(chat_id, changes, window=None, expected=None):
+    """Асинхронный SettingsBatcher.submit(): пачки общие с синхронным кодом"""
+    batcher = core.settings_batcher
+    window = batcher.window if window is None else window
+    state, batch, is_leader = await _off_loop(batcher.join, chat_id, changes, expected)
+    if batch is None:
+        return core.VERSION_CONFLICT
+    if not is_leader:
+        try:
+            return await asyncio.wait_for(batch.wait_async(asyncio.get_running_loop()),
+                                          core.SETTINGS_BATCH_WAIT_TIMEOUT)
+        except asyncio.TimeoutError:
+            core.settings_log.warning("⏱️ Gave up waiting for the settings batch of %s", chat_id)
+            return core.BATCH_WAIT_TIMEOUT
+
+    result = None
+    try:
+        if window > 0:
+            await asyncio.sleep(window)
+        async with _apply_lock(state):
+            batcher.close(state, batch)
+            result = await apply_settings(chat_id)
+    except Exception as e:
+        result = {'ok': False, 'description': str(e)}
+    finally:
+        batch.finish(result)
+    return result
+
+async def sync_settings(chat_id, fresh=False):
+    """Асинхронный sync_settings()"""
+    result, generation = await telegram.get_chat(chat_id, fresh=fresh)
+    return await _off_loop(core._merge_synced, core.chats.get(chat_id),
+                           core._chat_permissions(chat_id, result), generation)
+
+async def handle_update(data, host):
+    """Асинхронный handle_update()"""
+    try:
+        reply = core.update_reply(data, host)
+        if reply is not None:
+            await telegram.call('sendMessage', reply)
+    except Exception as e:
+        core.webhook_log.exception("❌ Update handling error: %s", e)
+    finally:
+        update_tasks.pop(asyncio.current_task(), None)
+
+# Обновления в обработке (dict - в порядке поступления) - ограничены так же, как очередь вебхука
+update_tasks = {}
+core.metrics.register(core.Gauge('donk_webhook_tasks', 'Updates being handled in ASGI mode',
+                                 lambda: len(update_tasks)))
+
+class _Request:
+    """Минимальный запрос: query-параметры, тело и заголовок Host"""
+
+    def __init__(self, scope, body):
+        self.args = {key: values[0] for key, values in parse_qs(scope.get('query_string', b'').decode()).items()}
+        self.body = body
+        self.headers = {name.decode('latin-1').lower(): value.decode('latin-1')
+                        for name, value in scope.get('headers', [])}
+        self.host = self.headers.get('host', '')
+
+    def flag(self, name):
+        return self.args.get(name, '').lower() in ('1', 'true', 'yes')
+
+    def if_match(self):
+        """ETags из If-Match или None (как _if_match())"""
+        etags = parse_etags(self.headers.get('if-match'))
+        return etags if etags else None
+
+    def json(self):
+        return json.loads(self.body) if self.body else None
+
+    def chat(self):
+        """Как _request_chat(): chat_id из query или JSON-тела"""
+        raw = self.args.get('chat_id')
+        if raw is None and self.headers.get('content-type', '').startswith('application/json'):
+            try:
+                raw = (self.json() or {}).get('chat_id')
+            except (ValueError, AttributeError):
+                raw = None
+        return core.chat_from_param(raw)
+
+_UNKNOWN_CHAT = ({'success': False, 'error': 'Unknown chat'}, 404)
+
+async def webhook(request):
+    if not core.BOT_TOKEN:
+        return 'OK'
+    try:
+        data = request.json()
+        if not core.accept_update(data):
+            return 'OK'
+        if len(update_tasks) >= core.WEBHOOK_QUEUE_SIZE:
+            core.update_queue.dropped += 1
+            if core.WEBHOOK_OVERFLOW == 'drop_oldest':
+                # Как в UpdateQueue: старейшее обновление отменяем, новое принимаем
+                oldest = next(iter(update_tasks))
+                update_tasks.pop(oldest)
+                oldest.cancel()
+                core.webhook_log.warning("⚠️ Too many updates in progress, dropped oldest update")
+            else:
+                core.webhook_log.warning("⚠️ Too many updates in progress (%s), update not accepted",
+                                         core.WEBHOOK_OVERFLOW)
+                if core.WEBHOOK_OVERFLOW == 'reject':
+                    core.update_dedup.forget(data.get('update_id'))
+                    return 'Queue full', 503
+                return 'OK'
+        update_tasks[telegram.spawn(handle_update(data, request.host))] = None
+    except Exception as e:
+        core.webhook_log.exception("❌ Webhook error: %s", e)
+    return 'OK'
+
+async def api_update(request):
+    try:
+        state = request.chat()
+        if state is None:
+            return _UNKNOWN_CHAT
+        data = request.json()
+        setting = data.get('setting')
+        value = bool(data.get('value'))
+        core.api_log.info("🔄 API: Updating %s to %s in %s", setting, value, state.chat_id)
+        if setting not in core.DEFAULT_SETTINGS:
+            core.api_log.warning("❌ API: Invalid setting: %s", setting)
+            return {'success': False, 'error': 'Invalid setting'}
+        result = await submit_settings(state.chat_id, {setting: value}, expected=request.if_match())
+        if result.get('ok'):
+            core.api_log.info("✅ API: Successfully updated %s", setting)
+        elif result.get('conflict'):
+            core.api_log.info("🔀 API: Version conflict for %s in %s", setting, state.chat_id)
+        else:
+            core.api_log.warning("❌ API: Telegram API error for %s", setting)
+        return core.update_response(state, result, f'{setting} set to {value}')
+    except Exception as e:
+        core.api_log.exception("❌ API: Exception: %s", e)
+        return {'success': False, 'error': str(e)}
+
+async def api_update_batch(request):
+    try:
+        state = request.chat()
+        if state is None:
+            return _UNKNOWN_CHAT
+        changes, error = core.validate_settings((request.json() or {}).get('settings'))
+        if error:
+            core.api_log.warning("❌ API: Invalid batch for %s: %s", state.chat_id, error)
+            return {'success': False, 'error': error}, 400
+        core.api_log.info("🔄 API: Updating %d settings in %s", len(changes), state.chat_id)
+        result = await submit_settings(state.chat_id, changes, expected=request.if_match())
+        return core.update_response(state, result, f'{len(changes)} settings updated')
+    except Exception as e:
+        core.api_log.exception("❌ API: Batch exception: %s", e)
+        return {'success': False, 'error': str(e)}
+
+async def api_sync(request):
+    try:
+        state = request.chat()
+        if state is None:
+            return _UNKNOWN_CHAT
+        fresh = request.flag('fresh')
+        core.api_log.info("🔄 API: Syncing settings for %s with Telegram (fresh=%s)", state.chat_id, fresh)
+        return core.sync_response(state, await sync_settings(state.chat_id, fresh=fresh))
+    except Exception as e:
+        core.api_log.exception("❌ API: Sync exception: %s", e)
+        return {'success': False, 'error': str(e)}
+
+async def api_apply(request):
+    try:
+        state = request.chat()
+        if state is None:
+            return _UNKNOWN_CHAT
+        force = request.flag('force')
+        core.api_log.info("🎯 API: Applying all settings to %s (force=%s)", state.chat_id, force)
+        async with _apply_lock(state):
+            result = await apply_settings(state.chat_id, force=force)
+        return core.apply_response(state, result)
+    except Exception as e:
+        core.api_log.exception("❌ API: Apply exception: %s", e)
+        return {'success': False, 'error': str(e)}
+
+ROUTES = {
+    ('POST', '/webhook'): webhook,
+    ('POST', '/api/update'): api_update,
+    ('POST', '/api/update_batch'): api_update_batch,
+    ('GET', '/api/sync'): api_sync,
+    ('GET', '/api/apply'): api_apply,
+}
+
+async def _read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+async def _send(send, path, result):
+    """Отправляет ответ обработчика: dict -> JSON, str -> текст, (тело, статус)"""
+    body, status = result if isinstance(result, tuple) else (result, None)
+    headers = []
+    if isinstance(body, dict):
+        payload, content_type = json.dumps(body).encode('utf-8'), b'application/json'
+        if 'etag' in body:
+            headers.append((b'etag', quote_etag(body['etag']).encode()))
+        status = status or core.response_status(body)
+    else:
+        payload, content_type = body.encode('utf-8'), b'text/html; charset=utf-8'
+    status = status or 200
+    headers += [(b'content-type', content_type), (b'content-length', str(len(payload)).encode())]
+    if path.startswith('/api/'):
+        headers.append((b'x-telegram-circuit', core.telegram_breaker.state.encode()))
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': payload})
+    return status
+
+class AsgiApp:
+    """Асинхронные маршруты поверх Flask-приложения"""
+
+    def __init__(self, flask_app):
+        self.wsgi = WSGIMiddleware(flask_app, workers=ASGI_WSGI_THREADS)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self._lifespan(receive, send)
+        handler = ROUTES.get((scope.get('method'), scope.get('path'))) if scope['type'] == 'http' else None
+        if handler is None:
+            return await self.wsgi(scope, receive, send)
+
+        started = time.perf_counter()
+        # В общем режиме prepare_request() перечитывает SQLite
+        await _off_loop(core.prepare_request)
+        request = _Request(scope, await _read_body(receive))
+        status = await _send(send, scope['path'], await handler(request))
+        core.http_request_duration.observe(time.perf_counter() - started,
+                                           scope['path'], scope['method'], status)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                core.start_initial_sync()
+                core.start_scheduler()
+                if core.BOT_TOKEN and core.BOT_MODE == 'polling':
+                    core.UpdatePoller(core.update_queue, core.PUBLIC_HOST).start()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await telegram.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+app = AsgiApp(core.app)
+
+if __name__ == '__main__':
+    import uvicorn
+    core.app_log.info("🚀 Starting Group Settings Manager (ASGI)")
+    uvicorn.run(app, host='0.0.0.0', port=int(os.environ.get('PORT', 5000)))
@@ -0,0 +1,259 @@
+"""Нагрузочный тест app.py против локального поддельного Bot API.
+
+Поднимает fake_telegram.py и само приложение в этом же процессе, гоняет
+выбранные сценарии на заданных уровнях параллельности и печатает
+пропускную способность и p50/p95/p99.
+
+    python bench.py --scenarios webhook,update,sync --concurrency 1,8,32 --requests 500 --latency-ms 50
+
+--server asgi гоняет то же через asgi.py под uvicorn (нужны зависимости ASGI-режима).
+
+Сценарий polling забирает обновления через getUpdates, как UpdatePoller приложения;
+уровень в нём - число обновлений на один getUpdates, задержки - время одного опроса.
+
+После каждого уровня прогон ждёт, пока приложение отправит всё накопленное
+(очередь вебхуков и исходящие вызовы, например sendMessage под лимитом на чат),
+но не дольше --drain-timeout; неотправленный остаток печатается в колонке queued.
+
+Переменные окружения приложения (SETTINGS_BATCH_WINDOW_MS, WEBHOOK_WORKERS и т.д.)
+передаются как обычно. --max-p99-ms и --min-rps завершают прогон с кодом 1,
+если результат хуже порога.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.serving import make_server
+import argparse
+import itertools
+import json
+import os
+import random
+import sys
+import threading
+import time
+import requests
+import fake_telegram
+
+def _update(user_id, update_id):
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'from': {'id': user_id, 'is_bot': False},
+            # Свой чат у каждого обновления: ответы в один чат упираются в лимит 1/с на чат
+            'chat': {'id': fake_telegram.SYNTHETIC_CHAT_BASE + update_id, 'type': 'private'},
+            'text': '/settings'
+        }
+    }
+
+def _scenarios(app_module):
+    """Сценарий: функция (session, base_url, номер запроса) -> ok"""
+    user_id = next(iter(app_module.ALLOWED_USER_IDS))
+    settings = list(app_module.DEFAULT_SETTINGS)
+    # update_id уникален на весь прогон, иначе повторы отсеет дедупликация
+    update_ids = itertools.count(1)
+
+    def webhook(session, base, n):
+        return session.post(f"{base}/webhook", json=_update(user_id, next(update_ids))).status_code == 200
+
+    def update(session, base, n):
+        response = session.post(f"{base}/api/update", json={
+            'setting': random.choice(settings), 'value': random.random() < 0.5})
+        return response.status_code == 200 and response.json().get('success', False)
+
+    def sync(session, base, n):
+        response = session.get(f"{base}/api/sync")
+        return response.status_code == 200 and response.json().get('success', False)
+
+    def settings_api(session, base, n):
+        return session.get(f"{base}/api/settings").status_code == 200
+
+    def settings_page(session, base, n):
+        return session.get(f"{base}/settings").status_code == 200
+
+    return {
+        'webhook': webhook,
+        'update': update,
+        'sync': sync,
+        'settings': settings_api,
+        'page': settings_page,
+    }
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+def run_level(base, scenario, concurrency, total):
+    """Прогоняет total запросов сценария с заданной параллельностью"""
+    local = threading.local()
+
+    def one(n):
+        session = getattr(local, 'session', None)
+        if session is None:
+            session = local.session = requests.Session()
+        started = time.perf_counter()
+        try:
+            ok = scenario(session, base, n)
+        except requests.RequestException:
+            ok = False
+        return time.perf_counter() - started, ok
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        results = list(pool.map(one, range(total)))
+    elapsed = time.perf_counter() - started
+
+    latencies = sorted(latency for latency, _ in results)
+    return {
+        'requests': total,
+        'errors': sum(1 for _, ok in results if not ok),
+        'seconds': round(elapsed, 3),
+        'rps': round(total / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+    }
+
+def run_polling(app_module, fake, batch, total):
+    """Забирает total обновлений через getUpdates по batch за опрос"""
+    poller = app_module.UpdatePoller(app_module.update_queue, 'bench', limit=batch)
+    fake.updates_per_poll = batch
+    latencies = []
+    errors = 0
+    started = time.perf_counter()
+    try:
+        while poller.received < total:
+            poll_started = time.perf_counter()
+            if poller.poll_once() is None:
+                errors += 1
+            latencies.append(time.perf_counter() - poll_started)
+    finally:
+        fake.updates_per_poll = 0
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'requests': poller.received,
+        'errors': errors,
+        'seconds': round(elapsed, 3),
+        'rps': round(poller.received / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+    }
+
+def backlog(app_module):
+    """Обновления и вызовы Telegram, которые приложение ещё не обработало"""
+    pending = app_module.update_queue.depth() + app_module.telegram_in_flight.value()
+    pending += sum(app_module.outbound_dispatcher.depth(priority) for priority in app_module.PRIORITY_CLASSES)
+    asgi = sys.modules.get('asgi')
+    if asgi is not None:
+        # Задачи ASGI-режима: обработка вебхуков и fire-and-forget вызовы
+        pending += len(asgi.telegram._tasks)
+    return pending
+
+def _serve_asgi():
+    """Запускает asgi.py под uvicorn в фоновом потоке, возвращает base_url"""
+    import socket
+    import uvicorn
+    import asgi
+
+    sock = socket.socket()
+    # Без TCP_NODELAY на принимающем сокете ответы ждут delayed ACK (~40 мс)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.bind(('127.0.0.1', 0))
+    server = uvicorn.Server(uvicorn.Config(asgi.app, log_level='warning', access_log=False,
+                                           backlog=4096))
+    threading.Thread(target=server.run, kwargs={'sockets': [sock]}, name='bench-app', daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+    return f"http://127.0.0.1:{sock.getsockname()[1]}"
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark app.py against a fake Telegram Bot API')
+    parser.add_argument('--scenarios', default='webhook,update,sync',
+                        help='comma separated: webhook, update, sync, settings, page, polling')
+    parser.add_argument('--concurrency', default='1,8,32')
+    parser.add_argument('--requests', type=int, default=300, help='requests per level')
+    parser.add_argument('--latency-ms', type=float, default=50, help='fake Telegram latency')
+    parser.add_argument('--jitter-ms', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--rate-limit-rate', type=float, default=0)
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--server', choices=('wsgi', 'asgi'), default='wsgi',
+                        help='serve app.py with werkzeug threads or asgi.py with uvicorn')
+    parser.add_argument('--drain-timeout', type=float, default=120,
+                        help='seconds to wait for queued updates and Telegram calls after each level')
+    parser.add_argument('--json', help='write results to this file')
+    parser.add_argument('--max-p99-ms', type=float, help='fail if any level has a higher p99')
+    parser.add_argument('--min-rps', type=float, help='fail if any level has lower throughput')
+    args = parser.parse_args()
+
+    fake = fake_telegram.FakeTelegram(
+        latency=args.latency_ms / 1000, jitter=args.jitter_ms / 1000, error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate, retry_after=args.retry_after)
+    _, fake_url = fake_telegram.serve_in_background(fake)
+
+    # Приложение читает настройки при импорте, поэтому окружение готовим заранее
+    os.environ.setdefault('BOT_TOKEN', 'bench')
+    os.environ['TELEGRAM_API_URL'] = fake_url
+    os.environ.setdefault('SETTINGS_DB_PATH', '')
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    import app as app_module
+    fake.user_id = next(iter(app_module.ALLOWED_USER_IDS))
+    # update_id polling не должны совпасть с update_id вебхуков, иначе их отсеет дедупликация
+    fake.next_update_id = 10 ** 9
+
+    if args.server == 'asgi':
+        base = _serve_asgi()
+    else:
+        server = make_server('127.0.0.1', 0, app_module.app, threaded=True,
+                             request_handler=fake_telegram.QuietRequestHandler)
+        threading.Thread(target=server.serve_forever, name='bench-app', daemon=True).start()
+        base = f"http://127.0.0.1:{server.server_port}"
+
+    scenarios = _scenarios(app_module)
+    levels = [int(level) for level in args.concurrency.split(',') if level.strip()]
+    results = []
+    failed = False
+
+    print(f"🏁 Fake Telegram latency {args.latency_ms:.0f} ms, {args.requests} requests per level "
+          f"({args.server})")
+    print(f"{'scenario':<10} {'conc':>5} {'rps':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} "
+          f"{'errors':>7} {'tg calls':>9} {'queued':>7}")
+    for name in [name.strip() for name in args.scenarios.split(',') if name.strip()]:
+        if name not in scenarios and name != 'polling':
+            parser.error(f"unknown scenario: {name}")
+        for concurrency in levels:
+            fake.reset_counters()
+            if name == 'polling':
+                result = run_polling(app_module, fake, concurrency, args.requests)
+            else:
+                result = run_level(base, scenarios[name], concurrency, args.requests)
+            # Вебхуки и fire-and-forget вызовы уходят в фоне - ждём, пока всё отправится,
+            # иначе хвост попадёт в счётчики следующего уровня
+            deadline = time.monotonic() + args.drain_timeout
+            while backlog(app_module) and time.monotonic() < deadline:
+                time.sleep(0.01)
+            result['queued'] = backlog(app_module)
+            with fake.lock:
+                result['telegram_calls'] = dict(fake.calls)
+            result.update(scenario=name, concurrency=concurrency)
+            results.append(result)
+            print(f"{name:<10} {concurrency:>5} {result['rps']:>9} {result['p50_ms']:>9} "
+                  f"{result['p95_ms']:>9} {result['p99_ms']:>9} {result['errors']:>7} "
+                  f"{sum(result['telegram_calls'].values()):>9} {result['queued']:>7}")
+            if args.max_p99_ms is not None and result['p99_ms'] > args.max_p99_ms:
+                failed = True
+            if args.min_rps is not None and result['rps'] < args.min_rps:
+                failed = True
+
+    if args.json:
+        with open(args.json, 'w') as output:
+            json.dump(results, output, indent=2)
+    if failed:
+        print("❌ Benchmark thresholds exceeded")
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
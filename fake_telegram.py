@@ -0,0 +1,180 @@
+"""Локальная замена Telegram Bot API для нагрузочных тестов.
+
+Реализует методы, которые использует app.py: getChat, setChatPermissions,
+sendMessage, setWebhook, deleteWebhook и getUpdates. Задержка, доля ошибок
+и доля ответов 429 настраиваются. getUpdates при --updates-per-poll отдаёт
+команды /settings от администратора --user-id, каждую из своего чата.
+
+    python fake_telegram.py --port 8081 --latency-ms 50 --error-rate 0.01
+    TELEGRAM_API_URL=http://127.0.0.1:8081 python app.py
+"""
+from flask import Flask, request, jsonify
+from werkzeug.serving import WSGIRequestHandler, make_server
+import argparse
+import random
+import threading
+import time
+
+DEFAULT_PERMISSIONS = {
+    'can_send_messages': True,
+    'can_send_media_messages': True,
+    'can_send_photos': True,
+    'can_send_videos': True,
+    'can_send_video_notes': True,
+    'can_send_voice_notes': True,
+    'can_send_stickers': True,
+    'can_send_polls': True,
+    'can_change_info': False,
+    'can_invite_users': True,
+    'can_pin_messages': False
+}
+
+# Первый из ALLOWED_USER_IDS app.py по умолчанию - иначе приложение отбросит обновления
+DEFAULT_USER_ID = 1444832263
+
+# Синтетические чаты: у каждого обновления свой, чтобы не упираться в лимит на чат
+SYNTHETIC_CHAT_BASE = 10 ** 12
+
+class FakeTelegram:
+    """Состояние и поведение поддельного Bot API"""
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, rate_limit_rate=0.0,
+                 retry_after=1, updates_per_poll=0, user_id=DEFAULT_USER_ID):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        # Сколько синтетических обновлений отдавать на каждый getUpdates
+        self.updates_per_poll = updates_per_poll
+        # Отправитель синтетических обновлений
+        self.user_id = user_id
+        self.lock = threading.Lock()
+        self.permissions = {}
+        self.calls = {}
+        self.webhook_url = ''
+        self.next_update_id = 1
+
+    def count(self, method):
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+
+    def reset_counters(self):
+        with self.lock:
+            self.calls = {}
+
+    def _delay(self):
+        delay = self.latency + (random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay > 0:
+            time.sleep(delay)
+
+    def _injected_error(self):
+        roll = random.random()
+        if roll < self.rate_limit_rate:
+            return jsonify({
+                'ok': False,
+                'error_code': 429,
+                'description': f'Too Many Requests: retry after {self.retry_after}',
+                'parameters': {'retry_after': self.retry_after}
+            }), 429
+        if roll < self.rate_limit_rate + self.error_rate:
+            return jsonify({'ok': False, 'error_code': 500, 'description': 'Internal Server Error'}), 500
+        return None
+
+    def handle(self, method, data):
+        """Ответ на вызов метода; возвращает (тело, статус)"""
+        if method == 'getChat':
+            with self.lock:
+                permissions = dict(self.permissions.get(data.get('chat_id'), DEFAULT_PERMISSIONS))
+            return {'ok': True, 'result': {'id': data.get('chat_id'), 'type': 'supergroup',
+                                           'title': 'Fake group', 'permissions': permissions}}, 200
+        if method == 'setChatPermissions':
+            with self.lock:
+                current = self.permissions.setdefault(data.get('chat_id'), dict(DEFAULT_PERMISSIONS))
+                current.update(data.get('permissions') or {})
+            return {'ok': True, 'result': True}, 200
+        if method == 'sendMessage':
+            return {'ok': True, 'result': {'message_id': random.randint(1, 10 ** 9),
+                                           'chat': {'id': data.get('chat_id')},
+                                           'text': data.get('text', '')}}, 200
+        if method == 'setWebhook':
+            self.webhook_url = data.get('url', '')
+            return {'ok': True, 'result': True, 'description': 'Webhook was set'}, 200
+        if method == 'deleteWebhook':
+            self.webhook_url = ''
+            return {'ok': True, 'result': True, 'description': 'Webhook was deleted'}, 200
+        if method == 'getUpdates':
+            return {'ok': True, 'result': self._updates(data)}, 200
+        return {'ok': False, 'error_code': 404, 'description': 'Not Found: method not found'}, 404
+
+    def _updates(self, data):
+        if not self.updates_per_poll:
+            # Имитируем long polling без новых обновлений
+            time.sleep(min(float(data.get('timeout', 0)), 1))
+            return []
+        limit = min(int(data.get('limit', 100)), self.updates_per_poll)
+        with self.lock:
+            first = max(self.next_update_id, int(data.get('offset') or 0))
+            self.next_update_id = first + limit
+        return [{'update_id': update_id,
+                 'message': {'message_id': update_id, 'from': {'id': self.user_id, 'is_bot': False},
+                             'chat': {'id': SYNTHETIC_CHAT_BASE + update_id, 'type': 'private'},
+                             'text': '/settings'}}
+                for update_id in range(first, first + limit)]
+
+def create_app(fake):
+    """Flask-приложение, отвечающее как api.telegram.org"""
+    fake_app = Flask(__name__)
+
+    @fake_app.route('/bot<token>/<method>', methods=['GET', 'POST'])
+    def bot_method(token, method):
+        fake.count(method)
+        fake._delay()
+        error = fake._injected_error()
+        if error is not None:
+            return error
+        body, status = fake.handle(method, request.get_json(silent=True) or {})
+        return jsonify(body), status
+
+    @fake_app.route('/stats')
+    def stats():
+        with fake.lock:
+            return jsonify({'calls': dict(fake.calls), 'webhook_url': fake.webhook_url})
+
+    return fake_app
+
+class QuietRequestHandler(WSGIRequestHandler):
+    """Обработчик без журнала доступа - он искажает замеры"""
+
+    def log_request(self, *args, **kwargs):
+        pass
+
+def serve_in_background(fake, host='127.0.0.1', port=0):
+    """Запускает сервер в фоновом потоке, возвращает (server, base_url)"""
+    server = make_server(host, port, create_app(fake), threaded=True,
+                         request_handler=QuietRequestHandler)
+    threading.Thread(target=server.serve_forever, name='fake-telegram', daemon=True).start()
+    return server, f"http://{host}:{server.server_port}"
+
+def main():
+    parser = argparse.ArgumentParser(description='Local fake Telegram Bot API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--jitter-ms', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--rate-limit-rate', type=float, default=0)
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--updates-per-poll', type=int, default=0)
+    parser.add_argument('--user-id', type=int, default=DEFAULT_USER_ID, help='sender of synthetic updates')
+    args = parser.parse_args()
+
+    fake = FakeTelegram(latency=args.latency_ms / 1000, jitter=args.jitter_ms / 1000,
+                        error_rate=args.error_rate, rate_limit_rate=args.rate_limit_rate,
+                        retry_after=args.retry_after, updates_per_poll=args.updates_per_poll,
+                        user_id=args.user_id)
+    print(f"🧪 Fake Telegram Bot API on http://{args.host}:{args.port}")
+    create_app(fake).run(host=args.host, port=args.port, threaded=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,260 @@
+// Текущие настройки на сервере и их версия (ETag для If-Match)
+const initial = JSON.parse(document.getElementById('initial-settings').textContent);
+let currentSettings = initial.settings;
+let currentVersion = initial.version;
+let currentEtag = initial.etag;
+// Переключения, ещё не отправленные на сервер: настройка -> {value, base}
+let pendingChanges = {};
+// Отправленные и ещё не подтверждённые; одновременно идёт не больше одного запроса
+let inFlight = null;
+// Группа, настройки которой открыты
+const chatId = new URLSearchParams(window.location.search).get('chat_id');
+
+function apiUrl(path) {
+    return chatId ? path + '?chat_id=' + encodeURIComponent(chatId) : path;
+}
+
+// Загружаем настройки при загрузке страницы
+document.addEventListener('DOMContentLoaded', function() {
+    console.log('Initial settings:', currentSettings, 'version', currentVersion);
+    renderSettings();
+    showStatus('✅ Настройки загружены', 'success');
+});
+
+function acceptServerState(result, authoritative) {
+    // Запоздавшее событие SSE не откатывает более новый снимок. Ответы на наши запросы
+    // и первый снимок после (пере)подключения принимаем всегда: после перезапуска сервера
+    // без хранилища ревизия начинается заново
+    if (!authoritative && result.version < currentVersion) {
+        return;
+    }
+    currentSettings = result.settings;
+    currentVersion = result.version;
+    currentEtag = result.etag;
+    // Настройку, которую успел поменять кто-то другой, не перезаписываем вслепую
+    let dropped = 0;
+    for (const [setting, change] of Object.entries(pendingChanges)) {
+        if (currentSettings[setting] !== change.base) {
+            delete pendingChanges[setting];
+            dropped++;
+        }
+    }
+    if (dropped) {
+        showStatus('⚠️ Настройки изменил другой администратор', 'error');
+    }
+}
+
+function renderSettings() {
+    // Неподтверждённые изменения показываем поверх состояния сервера
+    const shown = Object.assign({}, currentSettings);
+    for (const changes of [inFlight || {}, pendingChanges]) {
+        for (const [setting, change] of Object.entries(changes)) {
+            shown[setting] = change.value;
+        }
+    }
+    updateUI(shown);
+}
+
+function updateUI(settings) {
+    console.log('Updating UI with settings:', settings);
+
+    // Основные разрешения
+    document.getElementById('can_send_messages').checked = settings.can_send_messages || false;
+    document.getElementById('can_send_polls').checked = settings.can_send_polls || false;
+
+    // Медиафайлы
+    document.getElementById('can_send_media_messages').checked = settings.can_send_media_messages || false;
+    document.getElementById('can_send_photos').checked = settings.can_send_photos || false;
+    document.getElementById('can_send_videos').checked = settings.can_send_videos || false;
+    document.getElementById('can_send_video_notes').checked = settings.can_send_video_notes || false;
+    document.getElementById('can_send_voice_notes').checked = settings.can_send_voice_notes || false;
+    document.getElementById('can_send_stickers').checked = settings.can_send_stickers || false;
+
+    // Управление группой
+    document.getElementById('can_change_info').checked = settings.can_change_info || false;
+    document.getElementById('can_invite_users').checked = settings.can_invite_users || false;
+    document.getElementById('can_pin_messages').checked = settings.can_pin_messages || false;
+
+    // Обновляем статусы
+    document.getElementById('messages_status').textContent = settings.can_send_messages ? 'ON' : 'OFF';
+    document.getElementById('polls_status').textContent = settings.can_send_polls ? 'ON' : 'OFF';
+    document.getElementById('media_status').textContent = settings.can_send_media_messages ? 'ON' : 'OFF';
+    document.getElementById('photos_status').textContent = settings.can_send_photos ? 'ON' : 'OFF';
+    document.getElementById('videos_status').textContent = settings.can_send_videos ? 'ON' : 'OFF';
+    document.getElementById('video_notes_status').textContent = settings.can_send_video_notes ? 'ON' : 'OFF';
+    document.getElementById('voice_notes_status').textContent = settings.can_send_voice_notes ? 'ON' : 'OFF';
+    document.getElementById('stickers_status').textContent = settings.can_send_stickers ? 'ON' : 'OFF';
+    document.getElementById('info_status').textContent = settings.can_change_info ? 'ON' : 'OFF';
+    document.getElementById('invite_status').textContent = settings.can_invite_users ? 'ON' : 'OFF';
+    document.getElementById('pin_status').textContent = settings.can_pin_messages ? 'ON' : 'OFF';
+}
+
+function queueChange(setting, value) {
+    // base - значение, от которого администратор отталкивался при переключении
+    const known = inFlight && setting in inFlight ? inFlight[setting].value : currentSettings[setting];
+    const base = setting in pendingChanges ? pendingChanges[setting].base : known;
+    if (value === base) {
+        delete pendingChanges[setting];
+    } else {
+        pendingChanges[setting] = {value: value, base: base};
+    }
+}
+
+function toggleSetting(setting, value, statusElement) {
+    console.log('Toggling setting:', setting, 'to:', value);
+    queueChange(setting, value);
+    renderSettings();
+    flushChanges();
+}
+
+function flushChanges() {
+    // Быстрые переключения копятся, пока идёт предыдущий запрос, и уходят одним
+    if (inFlight || Object.keys(pendingChanges).length === 0) {
+        return;
+    }
+    const sent = inFlight = pendingChanges;
+    pendingChanges = {};
+    const settings = {};
+    for (const [setting, change] of Object.entries(sent)) {
+        settings[setting] = change.value;
+    }
+    showStatus('🔄 Изменение настроек...', 'info');
+
+    fetch(apiUrl('/api/update_batch'), {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json',
+            'If-Match': '"' + currentEtag + '"',
+        },
+        body: JSON.stringify({settings: settings})
+    })
+    .then(response => response.json().then(result => ({status: response.status, result: result})))
+    .then(({status, result}) => {
+        console.log('Update result:', status, result);
+        inFlight = null;
+        if (status === 412) {
+            // Версия устарела: возвращаем изменения в очередь и повторяем с новой
+            for (const [setting, change] of Object.entries(sent)) {
+                const later = pendingChanges[setting];
+                pendingChanges[setting] = {value: later ? later.value : change.value, base: change.base};
+                if (pendingChanges[setting].value === change.base) {
+                    delete pendingChanges[setting];
+                }
+            }
+        }
+        if (result.settings) {
+            // В том числе при 412: новый ETag нужен для повтора
+            acceptServerState(result, true);
+        }
+        if (result.success) {
+            showStatus('✅ Настройка применена!', 'success');
+        } else if (status !== 412) {
+            showStatus('❌ Ошибка: ' + result.error, 'error');
+        }
+        renderSettings();
+        flushChanges();
+    })
+    .catch(error => {
+        console.error('Error updating settings:', error);
+        inFlight = null;
+        showStatus('❌ Ошибка сети: ' + error.message, 'error');
+        // Неподтверждённое сервером не показываем - переключатели возвращаются
+        renderSettings();
+    });
+}
+
+function syncSettings() {
+    showStatus('🔄 Синхронизация с Telegram...', 'info');
+
+    fetch(apiUrl('/api/sync'))
+        .then(response => {
+            if (!response.ok) {
+                throw new Error('Network response was not ok: ' + response.status);
+            }
+            return response.json();
+        })
+        .then(result => {
+            console.log('Sync result:', result);
+            if (result.success) {
+                acceptServerState(result, true);
+                renderSettings();
+                showStatus('✅ Настройки синхронизированы!', 'success');
+            } else {
+                showStatus('❌ Ошибка синхронизации: ' + result.message, 'error');
+            }
+        })
+        .catch(error => {
+            console.error('Error syncing settings:', error);
+            showStatus('❌ Ошибка сети при синхронизации: ' + error.message, 'error');
+        });
+}
+
+function applyAllSettings() {
+    showStatus('🎯 Применение всех настроек...', 'info');
+
+    fetch(apiUrl('/api/apply'))
+        .then(response => {
+            if (!response.ok) {
+                throw new Error('Network response was not ok: ' + response.status);
+            }
+            return response.json();
+        })
+        .then(result => {
+            console.log('Apply result:', result);
+            if (result.success && result.skipped) {
+                showStatus('✅ Настройки уже применены', 'success');
+            } else if (result.success) {
+                showStatus('✅ Все настройки применены!', 'success');
+            } else {
+                showStatus('❌ Ошибка применения настроек: ' + result.message, 'error');
+            }
+        })
+        .catch(error => {
+            console.error('Error applying settings:', error);
+            showStatus('❌ Ошибка сети: ' + error.message, 'error');
+        });
+}
+
+// Пресеты: одна карта разрешений - один запрос и один вызов Telegram
+const presets = JSON.parse(document.getElementById('presets').textContent);
+
+function applyPreset(name) {
+    // Пресет встаёт в ту же очередь, что и переключатели, и уходит одним запросом
+    for (const [setting, value] of Object.entries(presets[name])) {
+        queueChange(setting, value);
+    }
+    renderSettings();
+    flushChanges();
+}
+
+function showStatus(message, type) {
+    const status = document.getElementById('status');
+    status.textContent = message;
+    status.className = 'status ' + type;
+    status.style.display = 'block';
+
+    setTimeout(() => {
+        status.style.display = 'none';
+    }, 3000);
+}
+
+// Живые обновления: изменения других администраторов приходят сами
+if (typeof EventSource !== 'undefined') {
+    const stream = new EventSource(apiUrl('/api/stream'));
+    // Первое событие после подключения - текущее состояние сервера
+    let connected = false;
+    stream.addEventListener('open', function() {
+        connected = true;
+    });
+    stream.addEventListener('settings', function(event) {
+        acceptServerState(JSON.parse(event.data), connected);
+        connected = false;
+        renderSettings();
+    });
+}
+
+// Инициализация Telegram Web App
+if (typeof Telegram !== 'undefined' && Telegram.WebApp) {
+    Telegram.WebApp.ready();
+    Telegram.WebApp.expand();
+}